@@ -38,6 +38,9 @@ class SimpleBackendHandler(http.server.SimpleHTTPRequestHandler):
         self.wfile.write(b'Received POST data: ' + post_data)
 
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        BACKEND_PORT = int(sys.argv[1])
     with socketserver.TCPServer(("", BACKEND_PORT), SimpleBackendHandler) as httpd:
         print(f"[*] Backend server started on port {BACKEND_PORT}")
         httpd.serve_forever()
@@ -0,0 +1,96 @@
+# benchmarks/bench_ml_inference.py
+# Compare sklearn predict() with FastForest (waf_fast_forest.py) on waf_model.joblib:
+# checks that predictions match exactly, then times single rows and small batches.
+#
+# Usage: python benchmarks/bench_ml_inference.py [--model waf_model.joblib]
+#        [--features waf_features.csv] [--repeat 2000]
+
+import argparse
+import csv
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import joblib
+import numpy as np
+
+from waf_fast_forest import FastForest
+
+FEATURE_COLUMNS = ['length', 'num_special', 'num_digits', 'has_sql_keywords']
+
+
+def load_rows(features_csv):
+    rows = []
+    if os.path.exists(features_csv):
+        with open(features_csv, newline='') as f:
+            for rec in csv.DictReader(f):
+                try:
+                    rows.append([float(rec[c]) for c in FEATURE_COLUMNS])
+                except (KeyError, ValueError):
+                    continue
+    return rows
+
+
+def edge_rows(forest, n_features, count=2000, seed=0):
+    """Rows whose values sit on, just below and just above split thresholds."""
+    rng = np.random.default_rng(seed)
+    split = forest.left != np.arange(len(forest.left))
+    thresholds = forest.threshold[split]
+    features = forest.feature[split]
+    out = rng.integers(0, 200, size=(count, n_features)).astype(np.float64)
+    picks = rng.integers(0, len(thresholds), size=count)
+    nudges = rng.choice([-1e-4, 0.0, 1e-4], size=count)
+    out[np.arange(count), features[picks]] = thresholds[picks] + nudges
+    return out
+
+
+def time_per_call(fn, arg, repeat):
+    fn(arg)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sklearn and FastForest inference on the WAF model.")
+    parser.add_argument('--model', default='waf_model.joblib')
+    parser.add_argument('--features', default='waf_features.csv')
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    # Models fitted on a DataFrame warn on every array input; that is noise here.
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+    model = joblib.load(args.model)
+    forest = FastForest.from_sklearn(model)
+    n_features = forest.n_features_in_ or len(FEATURE_COLUMNS)
+    print(f"Model: {type(model).__name__}, {forest.n_estimators} trees, "
+          f"{len(forest.feature)} nodes, max depth {forest.max_depth}")
+
+    rows = load_rows(args.features)
+    X = np.vstack([np.asarray(rows, dtype=np.float64).reshape(-1, n_features),
+                   edge_rows(forest, n_features)])
+    sk_proba = model.predict_proba(X)
+    fast_proba = forest.predict_proba(X)
+    same_pred = np.array_equal(model.predict(X), forest.predict(X))
+    same_proba = np.array_equal(sk_proba, fast_proba)
+    print(f"Checked {len(X)} rows ({len(rows)} from {args.features}): "
+          f"predictions {'identical' if same_pred else 'DIFFER'}, "
+          f"probabilities {'bit-identical' if same_proba else 'DIFFER'}")
+
+    print(f"\n{'batch':>6} {'sklearn us/call':>16} {'fast us/call':>13} {'speedup':>8}")
+    for batch in (1, 8, 64):
+        sample = X[:batch].tolist()
+        repeat = max(20, args.repeat // batch)
+        sk_us = time_per_call(model.predict, sample, min(repeat, 500))
+        fast_us = time_per_call(forest.predict, sample, repeat)
+        print(f"{batch:>6} {sk_us:>16.1f} {fast_us:>13.1f} {sk_us / fast_us:>7.1f}x")
+    if not (same_pred and same_proba):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
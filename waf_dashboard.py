@@ -12,6 +12,8 @@ from collections import Counter
 import urllib.request as _urllib_request
 import ipaddress
 import re as _re
+import time
+from waf_penalty import locked, read_bans, write_bans
 
 
 app = FastAPI()
@@ -427,13 +429,27 @@ def load_blocked_ips():
 
 
 def save_blocked_ips(ips):
+    # Write to a temp file and rename so the WAF never reads a half-written list
     try:
-        with open(BLOCKED_IPS_FILE, 'w') as f:
+        tmp_path = BLOCKED_IPS_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
             json.dump(list(ips), f)
+        os.replace(tmp_path, BLOCKED_IPS_FILE)
     except Exception:
         pass
 
 
+def _normalize_block_entry(entry):
+    """Return a canonical IP or CIDR string for the block list, or None if invalid."""
+    try:
+        entry = str(entry).strip()
+        if '/' in entry:
+            return str(ipaddress.ip_network(entry, strict=False))
+        return str(ipaddress.ip_address(entry))
+    except ValueError:
+        return None
+
+
 @app.get('/blocked_ips')
 def get_blocked_ips():
     return JSONResponse(content={"blocked": list(load_blocked_ips())})
@@ -445,6 +461,9 @@ async def block_ip(request: Request):
     ip = payload.get('ip')
     if not ip:
         return JSONResponse({"error": "missing ip"}, status_code=400)
+    ip = _normalize_block_entry(ip)
+    if not ip:
+        return JSONResponse({"error": "invalid ip or cidr"}, status_code=400)
     ips = load_blocked_ips()
     ips.add(ip)
     save_blocked_ips(ips)
@@ -458,12 +477,59 @@ async def unblock_ip(request: Request):
     if not ip:
         return JSONResponse({"error": "missing ip"}, status_code=400)
     ips = load_blocked_ips()
+    ip = _normalize_block_entry(ip) or ip
     if ip in ips:
         ips.remove(ip)
         save_blocked_ips(ips)
     return JSONResponse({"blocked": list(ips)})
 
 
+# Temporary bans written by the proxy's penalty box (see waf_penalty.py):
+# {"ip": {"until": <unix time>, "reason": "..."}}. Removing an entry lifts the ban.
+PENALTY_BOX_FILE = "penalty_box.json"
+
+
+def load_penalty_box():
+    """Return {ip: {"until", "reason"}} for bans that have not expired yet."""
+    now = time.time()
+    return {ip: entry for ip, entry in read_bans(PENALTY_BOX_FILE).items() if entry['until'] > now}
+
+
+def lift_ban(ip):
+    """Remove ip from the penalty box file (under the proxy's lock); True if it was banned."""
+    try:
+        with locked(PENALTY_BOX_FILE):
+            bans = read_bans(PENALTY_BOX_FILE)
+            if ip not in bans:
+                return False
+            del bans[ip]
+            write_bans(PENALTY_BOX_FILE, bans)
+        return True
+    except Exception:
+        return False
+
+
+def _penalty_box_rows():
+    now = time.time()
+    return [{"ip": ip, "reason": entry.get('reason'), "expires_in": int(entry['until'] - now)}
+            for ip, entry in sorted(load_penalty_box().items(), key=lambda item: item[1]['until'])]
+
+
+@app.get('/penalty_box')
+def get_penalty_box():
+    return JSONResponse(content={"banned": _penalty_box_rows()})
+
+
+@app.post('/unban')
+async def unban_ip(request: Request):
+    payload = await request.json()
+    ip = payload.get('ip')
+    if not ip:
+        return JSONResponse({"error": "missing ip"}, status_code=400)
+    lift_ban(_normalize_block_entry(ip) or ip)
+    return JSONResponse({"banned": _penalty_box_rows()})
+
+
 @app.get('/sse')
 async def sse_stream():
     async def event_generator():
@@ -483,10 +549,10 @@ async def sse_stream():
                             continue
                 else:
                     requests = []
-                payload = {"requests": requests, "blocked": list(load_blocked_ips())}
+                payload = {"requests": requests, "blocked": list(load_blocked_ips()), "banned": _penalty_box_rows()}
                 yield f"data: {json.dumps(payload)}\n\n"
             except Exception:
-                yield f"data: {json.dumps({'requests': [], 'blocked': list(load_blocked_ips())})}\n\n"
+                yield f"data: {json.dumps({'requests': [], 'blocked': list(load_blocked_ips()), 'banned': []})}\n\n"
             await asyncio.sleep(2)
     return StreamingResponse(event_generator(), media_type='text/event-stream')
 
@@ -524,18 +590,27 @@ def live_page():
             <tbody></tbody>
           </table>
         </div>
+        <h3 style="margin-top:20px">Penalty Box</h3>
+        <div class="card">
+          <table id="banTable">
+            <thead><tr><th>IP</th><th>Last block reason</th><th>Expires in</th><th>Action</th></tr></thead>
+            <tbody></tbody>
+          </table>
+        </div>
+        <p style="margin-top:12px;color:#94a3b8">IPs with repeated blocked requests are banned temporarily by the WAF; lifting a ban takes effect within a second or two.</p>
         <p style="margin-top:12px;color:#94a3b8">Connected via Server-Sent Events (updates every ~2s). Use the action buttons to mark an IP as blocked/unblocked locally.</p>
         <p style="margin-top:6px;color:#94a3b8"><a href="/" style="color:#60a5fa">Back to Dashboard</a></p>
       </div>
 
       <script>
         const evtSource = new EventSource('/sse');
-        let current = { requests: [], blocked: [] };
+        let current = { requests: [], blocked: [], banned: [] };
 
         evtSource.onmessage = function(e) {
           try {
             current = JSON.parse(e.data);
             renderTable(current.requests, current.blocked);
+            renderBans(current.banned || []);
           } catch(err) {
             console.error('Failed to parse SSE data', err);
           }
@@ -561,6 +636,42 @@ def live_page():
           }
         }
 
+        function renderBans(banned) {
+          const tbody = document.querySelector('#banTable tbody');
+          tbody.innerHTML = '';
+          for (const b of banned) {
+            // textContent, not innerHTML: the reason comes from the request that was blocked
+            const tr = document.createElement('tr');
+            for (const text of [b.ip, b.reason || '', `${b.expires_in}s`]) {
+              const td = document.createElement('td');
+              td.textContent = text;
+              tr.appendChild(td);
+            }
+            const actionTd = document.createElement('td');
+            const btn = document.createElement('button');
+            btn.className = 'btn unblock';
+            btn.textContent = 'Lift ban';
+            btn.onclick = () => liftBan(b.ip);
+            actionTd.appendChild(btn);
+            tr.appendChild(actionTd);
+            tbody.appendChild(tr);
+          }
+        }
+
+        async function liftBan(ip) {
+          try {
+            const res = await fetch('/unban', {
+              method: 'POST', headers: {'Content-Type':'application/json'}, body: JSON.stringify({ ip })
+            });
+            const data = await res.json();
+            current.banned = data.banned;
+            renderBans(current.banned);
+          } catch(err) {
+            console.error('Lift ban failed', err);
+            alert('Action failed');
+          }
+        }
+
         document.getElementById('filter').addEventListener('input', function(){
           renderTable(current.requests, current.blocked);
         });
@@ -0,0 +1,116 @@
+# waf_fast_forest.py
+# Flat NumPy inference for the WAF's scikit-learn tree ensemble (waf_model.joblib).
+
+import numpy as np
+
+
+class FastForest:
+    """
+    A RandomForestClassifier (or single DecisionTreeClassifier) flattened into
+    plain NumPy arrays for low-latency prediction.
+
+    Every tree's nodes are concatenated into shared ``feature``, ``threshold``,
+    ``left`` and ``right`` arrays; leaves point to themselves, so all trees can
+    be walked together for exactly ``max_depth`` steps with a handful of array
+    operations per step, for one row or a small batch at once. Leaf values are
+    stored as per-tree class probabilities.
+
+    Predictions reproduce sklearn bit for bit: inputs are cast to float32 as
+    sklearn does before comparing against the float64 thresholds, leaf values
+    are taken exactly as DecisionTreeClassifier.predict_proba returns them,
+    and per-tree probabilities are summed in tree order (cumsum is a
+    sequential sum, matching sklearn's ``all_proba +=`` loop) before dividing
+    by the number of trees and taking argmax.
+    """
+
+    def __init__(self, feature, threshold, left, right, leaf_proba, roots, max_depth,
+                 classes, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.leaf_proba = leaf_proba
+        self.roots = roots
+        self.max_depth = max_depth
+        self.classes_ = classes
+        self.n_features_in_ = n_features
+        self.n_estimators = len(roots)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        """Build from a fitted RandomForestClassifier or DecisionTreeClassifier."""
+        estimators = getattr(model, 'estimators_', None)
+        if estimators is None:
+            estimators = [model]
+        if getattr(model, 'n_outputs_', 1) != 1:
+            raise ValueError("FastForest supports single-output classifiers only")
+        n_classes = len(model.classes_)
+        features, thresholds, lefts, rights, probas, roots = [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for est in estimators:
+            tree = est.tree_
+            n = tree.node_count
+            node_ids = np.arange(offset, offset + n, dtype=np.intp)
+            is_leaf = tree.children_left == -1
+            left = np.where(is_leaf, node_ids, tree.children_left + offset).astype(np.intp)
+            right = np.where(is_leaf, node_ids, tree.children_right + offset).astype(np.intp)
+            feature = np.where(is_leaf, 0, tree.feature).astype(np.intp)
+            proba = np.array(tree.value[:, 0, :n_classes], dtype=np.float64)
+            normalizer = proba.sum(axis=1)[:, np.newaxis]
+            if not np.allclose(normalizer, 1.0):
+                # sklearn < 1.4 stores class counts and normalises them in
+                # predict_proba; newer versions store fractions and return
+                # them as-is. Do whichever this model's sklearn does.
+                normalizer[normalizer == 0.0] = 1.0
+                proba /= normalizer
+            features.append(feature)
+            thresholds.append(np.asarray(tree.threshold, dtype=np.float64))
+            lefts.append(left)
+            rights.append(right)
+            probas.append(proba)
+            roots.append(offset)
+            max_depth = max(max_depth, int(tree.max_depth))
+            offset += n
+        return cls(
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            left=np.concatenate(lefts),
+            right=np.concatenate(rights),
+            leaf_proba=np.concatenate(probas),
+            roots=np.asarray(roots, dtype=np.intp),
+            max_depth=max_depth,
+            classes=np.asarray(model.classes_),
+            n_features=int(getattr(model, 'n_features_in_', 0)) or None,
+        )
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        n_rows, n_cols = X.shape
+        if self.n_features_in_ and n_cols != self.n_features_in_:
+            raise ValueError(f"X has {n_cols} features, model expects {self.n_features_in_}")
+        flat = X.ravel()
+        row_base = (np.arange(n_rows, dtype=np.intp) * n_cols)[:, np.newaxis]
+        node = np.broadcast_to(self.roots, (n_rows, self.n_estimators))
+        for _ in range(self.max_depth):
+            go_left = flat[row_base + self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        per_tree = self.leaf_proba[node]  # (rows, trees, classes)
+        return np.cumsum(per_tree, axis=1)[:, -1, :] / self.n_estimators
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+def compile_model(model):
+    """
+    Return a FastForest for a supported sklearn tree model, or the model
+    unchanged if it cannot be converted (other estimator types, multi-output).
+    """
+    try:
+        return FastForest.from_sklearn(model)
+    except (AttributeError, ValueError, TypeError) as e:
+        print(f"[WAF ML] fast inference unavailable, using sklearn predict(): {e}")
+        return model
@@ -0,0 +1,200 @@
+# waf_geoip.py
+# Cached country lookups for the WAF proxy, with an optional precomputed IPv4 range table.
+#
+# Build the range table offline from the GeoLite2 database (needs the maxminddb package):
+#   python waf_geoip.py build GeoLite2-Country.mmdb geoip_ranges.bin
+# or from a CSV of "start_ip,end_ip,country" lines (handy for small test tables):
+#   python waf_geoip.py build-csv ranges.csv geoip_ranges.bin
+# and check it with:
+#   python waf_geoip.py lookup geoip_ranges.bin 8.8.8.8 1.1.1.1
+
+import bisect
+import csv
+import functools
+import ipaddress
+import mmap
+import os
+import socket
+import struct
+import sys
+
+RANGE_TABLE_PATH = "geoip_ranges.bin"
+CACHE_SIZE = 65536  # distinct client IPs whose country (or lack of one) is remembered
+
+# File layout: 16-byte header (magic, range count, padding), then the start
+# addresses (uint32, native byte order, sorted), the end addresses (uint32,
+# inclusive) and a 2-byte ASCII country code per range.
+_MAGIC = b"WAFGEO1\x00"
+_HEADER = struct.Struct("=8sI4x")
+
+
+def _ipv4_int(ip):
+    """IPv4 address (or IPv4-mapped IPv6 address) as an int, or None."""
+    if ip.startswith("::ffff:") and "." in ip:
+        ip = ip[7:]
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except (OSError, ValueError):
+        return None
+
+
+class CountryRangeTable:
+    """
+    Sorted, non-overlapping IPv4 ranges with a country code each, read from a
+    file written by write_range_table().
+
+    The file is memory-mapped and its arrays are used in place (memoryview
+    casts), so opening it costs nothing and the pages are shared between WAF
+    processes. A lookup is one bisect over the start addresses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a WAF GeoIP range table")
+        view = memoryview(self._map)
+        start = _HEADER.size
+        self.starts = view[start:start + 4 * count].cast("I")
+        self.ends = view[start + 4 * count:start + 8 * count].cast("I")
+        self.codes = view[start + 8 * count:start + 10 * count]
+        if len(self.codes) != 2 * count:
+            raise ValueError(f"{path} is truncated")
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, ip):
+        """Country code for an IPv4 address string, or None if no range covers it."""
+        value = _ipv4_int(ip)
+        if value is None:
+            return None
+        return self.lookup_int(value)
+
+    def lookup_int(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i < 0 or value > self.ends[i]:
+            return None
+        return bytes(self.codes[2 * i:2 * i + 2]).decode("ascii")
+
+
+def write_range_table(path, ranges):
+    """
+    Write (start, end, country) ranges to path in CountryRangeTable format.
+
+    start and end are inclusive IPv4 addresses (strings or ints) and country
+    is a two-letter code. Ranges are sorted, adjacent ranges of the same
+    country are merged, and a range overlapping an earlier one is rejected.
+    Returns the number of ranges written.
+    """
+    rows = []
+    for start, end, country in ranges:
+        start = int(ipaddress.IPv4Address(start))
+        end = int(ipaddress.IPv4Address(end))
+        code = (country or "").strip().upper()
+        if len(code) != 2 or not code.isascii():
+            raise ValueError(f"bad country code {country!r}")
+        if end < start:
+            raise ValueError(f"range end before start: {start}-{end}")
+        rows.append((start, end, code))
+    rows.sort()
+    merged = []
+    for start, end, code in rows:
+        if merged and start <= merged[-1][1]:
+            raise ValueError(f"overlapping ranges at {ipaddress.IPv4Address(start)}")
+        if merged and start == merged[-1][1] + 1 and code == merged[-1][2]:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end, code])
+    count = len(merged)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, count))
+        f.write(struct.pack(f"={count}I", *[r[0] for r in merged]))
+        f.write(struct.pack(f"={count}I", *[r[1] for r in merged]))
+        f.write("".join(r[2] for r in merged).encode("ascii"))
+    os.replace(tmp_path, path)
+    return count
+
+
+def mmdb_ranges(mmdb_path):
+    """Yield (start, end, country) for every IPv4 network in a GeoLite2/GeoIP2 Country database."""
+    import maxminddb
+    with maxminddb.open_database(mmdb_path) as reader:
+        for network, record in reader:
+            if network.version != 4 or not isinstance(record, dict):
+                continue
+            country = (record.get("country") or record.get("registered_country") or {}).get("iso_code")
+            if country:
+                yield int(network.network_address), int(network.broadcast_address), country
+
+
+def csv_ranges(csv_path):
+    """Yield (start, end, country) from 'start_ip,end_ip,country' lines ('#' starts a comment)."""
+    with open(csv_path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].lstrip().startswith("#"):
+                continue
+            yield row[0].strip(), row[1].strip(), row[2].strip()
+
+
+class GeoIPResolver:
+    """
+    Client IP to ISO country code, with an LRU cache in front.
+
+    Lookups go to the range table first (IPv4 only) and then to the geoip2
+    reader, if either is configured. Unknown addresses are cached as None as
+    well, so repeat visitors never reach the table or the database twice.
+    """
+
+    def __init__(self, reader=None, table=None, cache_size=CACHE_SIZE):
+        self.reader = reader
+        self.table = table
+        self.cache_size = cache_size
+        self.country = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def __bool__(self):
+        return self.reader is not None or self.table is not None
+
+    def _resolve(self, ip):
+        if self.table is not None:
+            code = self.table.lookup(ip)
+            if code is not None or self.reader is None:
+                return code
+        if self.reader is None:
+            return None
+        try:
+            return self.reader.country(ip).country.iso_code
+        except Exception:
+            return None
+
+    def stats(self):
+        info = self.country.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize,
+                "maxsize": self.cache_size}
+
+
+def _main(argv):
+    usage = ("Usage: python waf_geoip.py build <db.mmdb> <out.bin> | "
+             "build-csv <ranges.csv> <out.bin> | lookup <table.bin> <ip>...")
+    if len(argv) >= 3 and argv[0] == "build":
+        count = write_range_table(argv[2], mmdb_ranges(argv[1]))
+        print(f"[*] wrote {count} IPv4 ranges to {argv[2]}")
+    elif len(argv) >= 3 and argv[0] == "build-csv":
+        count = write_range_table(argv[2], csv_ranges(argv[1]))
+        print(f"[*] wrote {count} IPv4 ranges to {argv[2]}")
+    elif len(argv) >= 3 and argv[0] == "lookup":
+        table = CountryRangeTable(argv[1])
+        for ip in argv[2:]:
+            print(f"{ip}\t{table.lookup(ip) or '-'}")
+    else:
+        print(usage)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,62 @@
+# waf_loader.py
+# Background loading of the proxy's slow startup dependencies (the ML model,
+# the GeoIP database), so the listening socket can accept traffic while they
+# load instead of after.
+
+import threading
+import time
+
+
+class BackgroundLoader:
+    """
+    Runs named load functions in daemon threads and tracks which are done.
+
+    load(name, fn, on_done) starts fn() in its own thread; when it returns,
+    on_done(result) installs the result and the component stops being
+    pending. A load that raises is reported and also stops being pending, so
+    callers fall back to running without it, as they do when a synchronous
+    load fails. Times are reported relative to ``started_at`` (by default the
+    moment the loader was created, i.e. process startup).
+    """
+
+    def __init__(self, started_at=None):
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.seconds = {}  # name -> seconds from startup until it was ready
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def since_start(self):
+        return time.monotonic() - self.started_at
+
+    def pending(self, name):
+        return name in self._pending
+
+    def load(self, name, fn, on_done=None):
+        with self._lock:
+            self._pending.add(name)
+        threading.Thread(target=self._run, args=(name, fn, on_done),
+                         name=f'waf-load-{name}', daemon=True).start()
+
+    def _run(self, name, fn, on_done):
+        began = time.monotonic()
+        try:
+            result = fn()
+            if on_done is not None:
+                on_done(result)
+        except Exception as e:
+            print(f"[WAF LOAD ERROR] {name}: {e}")
+        took = time.monotonic() - began
+        with self._lock:
+            self._pending.discard(name)
+            self.seconds[name] = self.since_start()
+            remaining = len(self._pending)
+        print(f"[*] Background load '{name}' ready {self.seconds[name]:.2f}s after startup (loaded in {took:.2f}s)")
+        if not remaining:
+            print(f"[*] All background loads finished {self.since_start():.2f}s after startup")
+
+    def status(self):
+        """{name: 1 if ready else 0} for every component ever loaded."""
+        with self._lock:
+            status = {name: 1 for name in self.seconds}
+            status.update({name: 0 for name in self._pending})
+            return status
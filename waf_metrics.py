@@ -0,0 +1,186 @@
+# waf_metrics.py
+# In-process latency histograms and counters for the WAF proxy, rendered in
+# Prometheus text format (served by waf.py at /__waf/metrics).
+
+import bisect
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds (+Inf is implicit).
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram: one bisect and three additions per observation."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+
+class LabeledCounter:
+    """Monotonic counters keyed by a label value."""
+
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label, amount=1):
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.values)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class RequestTimer:
+    """
+    Times one request through the handler's stages.
+
+    mark(stage) charges the time since the previous mark (or the start) to
+    ``stage`` and returns it; block() does the same for the stage that
+    rejected the request and counts the block reason. finish() records the
+    whole request.
+    """
+
+    __slots__ = ('metrics', 'started', 'last', 'outcome')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = self.last = time.perf_counter()
+        self.outcome = 'forwarded'
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.metrics.stage_seconds(stage).observe(elapsed)
+        self.last = now
+        return elapsed
+
+    def block(self, stage, reason=None):
+        elapsed = self.mark(stage)
+        self.outcome = 'blocked'
+        self.metrics.blocks.inc(reason or stage)
+        return elapsed
+
+    def finish(self):
+        now = time.perf_counter()
+        self.metrics.request_seconds.observe(now - self.started)
+        self.metrics.requests.inc(self.outcome)
+
+
+class WAFMetrics:
+    """
+    Per-process registry of the proxy's metrics.
+
+    Stage histograms are created on first use, so the handler decides which
+    stages exist. Extra values computed at scrape time (cache hit counts, log
+    queue drops) are added with add_collector(). With --workers every worker
+    has its own registry, so a scrape shows the worker that answered it.
+    """
+
+    def __init__(self, prefix='waf'):
+        self.prefix = prefix
+        self.request_seconds = Histogram()
+        self.requests = LabeledCounter()
+        self.blocks = LabeledCounter()
+        self._stages = {}
+        self._stages_lock = threading.Lock()
+        self._collectors = []
+
+    def stage_seconds(self, stage):
+        hist = self._stages.get(stage)
+        if hist is None:
+            with self._stages_lock:
+                hist = self._stages.setdefault(stage, Histogram())
+        return hist
+
+    def start_request(self):
+        return RequestTimer(self)
+
+    def add_collector(self, name, kind, help_text, fn):
+        """
+        Report fn() at scrape time: a number, or a dict mapping label strings
+        such as 'cache="ml"' to numbers. None or an exception skips the metric.
+        """
+        self._collectors.append((name, kind, help_text, fn))
+
+    def _render_histogram(self, lines, name, hist, labels=''):
+        counts, total, count = hist.snapshot()
+        cumulative = 0
+        sep = ',' if labels else ''
+        for bound, n in zip(hist.buckets + (float('inf'),), counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{_format_float(bound)}"}} {cumulative}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {total!r}')
+        lines.append(f'{name}_count{suffix} {count}')
+
+    def render(self):
+        """All metrics in Prometheus text exposition format (version 0.0.4)."""
+        p = self.prefix
+        lines = []
+        name = f'{p}_request_duration_seconds'
+        lines.append(f'# HELP {name} Time spent handling a request, end to end.')
+        lines.append(f'# TYPE {name} histogram')
+        self._render_histogram(lines, name, self.request_seconds)
+
+        name = f'{p}_stage_duration_seconds'
+        lines.append(f'# HELP {name} Time spent in each handle_request stage.')
+        lines.append(f'# TYPE {name} histogram')
+        for stage in sorted(self._stages):
+            self._render_histogram(lines, name, self._stages[stage], f'stage="{_escape(stage)}"')
+
+        for name, help_text, label, counter in (
+            (f'{p}_requests_total', 'Requests by outcome.', 'outcome', self.requests),
+            (f'{p}_blocks_total', 'Blocked requests by reason.', 'reason', self.blocks),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for value, count in sorted(counter.snapshot().items()):
+                lines.append(f'{name}{{{label}="{_escape(value)}"}} {count}')
+
+        for name, kind, help_text, fn in self._collectors:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            lines.append(f'# HELP {p}_{name} {help_text}')
+            lines.append(f'# TYPE {p}_{name} {kind}')
+            if isinstance(value, dict):
+                for label, v in sorted(value.items()):
+                    lines.append(f'{p}_{name}{{{label}}} {v}')
+            else:
+                lines.append(f'{p}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = WAFMetrics()
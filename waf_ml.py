@@ -0,0 +1,72 @@
+# waf_ml.py
+# ML model loading and memoised prediction for the WAF proxy.
+
+import functools
+import threading
+
+MODEL_PATH = "waf_model.joblib"
+CACHE_SIZE = 8192  # distinct feature vectors remembered
+
+
+def load_model(path=MODEL_PATH):
+    """Load a trained model with joblib and convert it for fast inference when possible."""
+    import joblib
+    from waf_fast_forest import compile_model
+    return compile_model(joblib.load(path))
+
+
+class CachedPredictor:
+    """
+    Bounded LRU cache from feature vector to model prediction.
+
+    The online features are four small integers, so most traffic maps onto a
+    few thousand distinct vectors; repeats are answered from the cache without
+    touching the model. set_model() swaps in a new model together with a fresh
+    cache, so a reload can never serve predictions from the old one. Hit and
+    miss counts (cumulative across reloads) are in stats().
+    """
+
+    def __init__(self, model=None, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.model = None
+        self.generation = 0
+        self._cached = None
+        self._retired_hits = 0
+        self._retired_misses = 0
+        self._lock = threading.Lock()
+        if model is not None:
+            self.set_model(model)
+
+    def set_model(self, model):
+        def predict(features):
+            return model.predict([list(features)])[0]
+        cached = functools.lru_cache(maxsize=self.maxsize)(predict)
+        with self._lock:
+            old = self._cached
+            # Single attribute swap: a request sees either the old model and
+            # its cache or the new model and its cache, never a mix.
+            self._cached = cached
+            self.model = model
+            self.generation += 1
+            if old is not None:
+                info = old.cache_info()
+                self._retired_hits += info.hits
+                self._retired_misses += info.misses
+
+    def predict_one(self, features):
+        """Prediction for one feature tuple (must be hashable)."""
+        return self._cached(features)
+
+    def predict(self, X):
+        """sklearn-style predict over a list of rows, using the cache per row."""
+        return [self._cached(tuple(row)) for row in X]
+
+    def stats(self):
+        info = self._cached.cache_info() if self._cached else None
+        return {
+            "hits": self._retired_hits + (info.hits if info else 0),
+            "misses": self._retired_misses + (info.misses if info else 0),
+            "size": info.currsize if info else 0,
+            "maxsize": self.maxsize,
+            "generation": self.generation,
+        }
@@ -0,0 +1,208 @@
+# waf_penalty.py
+# Penalty box: temporary per-IP bans for clients that keep getting blocked.
+#
+# Each blocked request counts as a strike against its IP. An IP that collects
+# ``threshold`` strikes within ``window`` seconds is banned for
+# ``ban_seconds``. The proxy turns a banned IP away before doing any other
+# work for it: no body read, no logging, no model or signature scan.
+#
+# Active bans are mirrored to penalty_box.json, e.g.
+#   {"203.0.113.7": {"until": 1792300000.0, "reason": "SQL Injection"}}
+# ("until" is a Unix timestamp; "reason" is the label of the last block, not
+# its free-text reason, which can contain attacker-supplied text). The file is
+# shared by the worker processes of one proxy and by the dashboard: a process
+# adopts bans it finds there, and removing an entry from the file lifts that
+# ban.
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+from waf_ratelimit import SlidingWindowRateLimiter
+
+PENALTY_FILE = 'penalty_box.json'
+THRESHOLD = 10        # blocked requests ...
+WINDOW = 60           # ... within this many seconds earn a ban
+BAN_SECONDS = 600
+MAX_BANS = 100000     # hard cap on banned IPs held in memory
+SYNC_INTERVAL = 1.0   # seconds between syncs with the penalty box file
+
+
+def read_bans(path):
+    """Return {ip: {"until": ..., "reason": ...}} from a penalty box file ({} if missing or unreadable)."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    bans = {}
+    for ip, entry in data.items():
+        if isinstance(entry, dict) and isinstance(entry.get('until'), (int, float)):
+            bans[ip] = {'until': float(entry['until']), 'reason': entry.get('reason')}
+    return bans
+
+
+def write_bans(path, bans):
+    """Write bans atomically (temp file + rename)."""
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'w') as f:
+        json.dump(bans, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock on ``<path>.lock`` for a read-modify-write of the penalty box file."""
+    try:
+        import fcntl
+    except ImportError:  # no fcntl (Windows): writes are still atomic, just not serialised
+        yield
+        return
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class PenaltyBox:
+    """
+    Strike counting plus the set of currently banned IPs.
+
+    Strikes are counted with the rate limiter's two-bucket sliding window
+    (``strikes`` may be a SharedSlidingWindowRateLimiter so that forked
+    workers count together), so the threshold is approximate in the same way
+    as the rate limit. Bans are a dict of ip -> (until, reason): banned() is
+    a single dict lookup for an IP that is not banned, and expired bans are
+    dropped lazily on lookup and on every sync. The dict is kept in ban
+    order, which with a fixed ban length is also expiry order, so when
+    ``max_bans`` is reached the ban closest to expiring is dropped.
+    """
+
+    def __init__(self, threshold=THRESHOLD, window=WINDOW, ban_seconds=BAN_SECONDS, path=PENALTY_FILE,
+                 strikes=None, max_bans=MAX_BANS, sync_interval=SYNC_INTERVAL):
+        self.threshold = threshold
+        self.window = window
+        self.ban_seconds = ban_seconds
+        self.path = path
+        self.strikes = strikes if strikes is not None else SlidingWindowRateLimiter(threshold - 1, window)
+        self.max_bans = max_bans
+        self.sync_interval = sync_interval
+        self.bans_total = 0
+        self.lifted = 0
+        self.evictions = 0
+        self._bans = {}
+        self._synced = set()  # IPs this process last saw in (or wrote to) the file
+        self._lock = threading.Lock()
+        self._stop = None
+
+    def __len__(self):
+        return len(self._bans)
+
+    def banned(self, ip, now=None):
+        """True if ip is serving a ban."""
+        entry = self._bans.get(ip)
+        if entry is None:
+            return False
+        if entry[0] > (time.time() if now is None else now):
+            return True
+        with self._lock:
+            if self._bans.get(ip) is entry:
+                del self._bans[ip]
+        return False
+
+    def strike(self, ip, reason=None, now=None):
+        """Count a blocked request from ip; returns True if this strike started a ban."""
+        if not self.strikes.hit(ip):
+            return False
+        until = (time.time() if now is None else now) + self.ban_seconds
+        with self._lock:
+            if ip in self._bans:
+                return False  # requests that were already in flight when the ban started
+            self._add(ip, until, reason)
+            self.bans_total += 1
+        print(f"[*] BANNED {ip} for {self.ban_seconds}s after {self.threshold} blocked requests "
+              f"within {self.window}s (last: {reason})")
+        return True
+
+    def _add(self, ip, until, reason):
+        if len(self._bans) >= self.max_bans:
+            del self._bans[next(iter(self._bans))]
+            self.evictions += 1
+        self._bans[ip] = (until, reason)
+
+    def sync(self, now=None):
+        """
+        Merge this process's bans with the penalty box file and write the
+        result back. Bans found only in the file are adopted; a ban this
+        process saw in the file earlier that is now missing was removed by
+        hand (e.g. from the dashboard) and is lifted. Expired bans are dropped.
+        """
+        now = time.time() if now is None else now
+        if self.path is None or (not self._bans and not self._synced and not os.path.exists(self.path)):
+            with self._lock:
+                self._purge(now)
+            return
+        with locked(self.path):
+            on_disk = read_bans(self.path)
+            lifted = []
+            with self._lock:
+                for ip in list(self._bans):
+                    if ip in self._synced and ip not in on_disk:
+                        del self._bans[ip]
+                        lifted.append(ip)
+                for ip, entry in on_disk.items():
+                    current = self._bans.get(ip)
+                    if current is None or current[0] < entry['until']:
+                        self._bans.pop(ip, None)
+                        self._add(ip, entry['until'], entry['reason'])
+                self._purge(now)
+                bans = {ip: {'until': round(until, 3), 'reason': reason}
+                        for ip, (until, reason) in self._bans.items()}
+                self._synced = set(bans)
+                self.lifted += len(lifted)
+            if bans != on_disk:
+                write_bans(self.path, bans)
+        for ip in lifted:
+            print(f"[*] Ban on {ip} lifted (removed from {self.path})")
+
+    def _purge(self, now):
+        expired = [ip for ip, (until, _) in self._bans.items() if until <= now]
+        for ip in expired:
+            del self._bans[ip]
+
+    def start(self):
+        """Load bans from the file and keep syncing from a daemon thread (once per process, after any fork)."""
+        if self._stop is not None:
+            return
+        self._stop = threading.Event()
+        stop = self._stop
+
+        def run():
+            while True:
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"[WAF PENALTY] sync with {self.path} failed: {e}")
+                if stop.wait(self.sync_interval):
+                    break
+
+        threading.Thread(target=run, name='waf-penalty-sync', daemon=True).start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+            try:
+                self.sync()
+            except Exception:
+                pass
+
+    def stats(self):
+        return {"banned": len(self._bans), "bans": self.bans_total, "lifted": self.lifted,
+                "evictions": self.evictions}
@@ -0,0 +1,281 @@
+# waf_pipeline.py
+# The WAF's content checks (User-Agent filter, signature scan, ML prediction)
+# as plain functions over a RequestContext, shared by the proxy and by offline
+# tools that run them on in-memory request records without any sockets.
+
+import codecs
+import collections
+import hashlib
+import http.client
+import threading
+import time
+
+from waf_request_context import RequestContext
+
+INSPECT_MAX_BYTES = 64 * 1024
+BODY_CHUNK_SIZE = 16 * 1024
+VERDICT_CACHE_SIZE = 10000  # distinct requests whose content verdict is remembered
+VERDICT_CACHE_TTL = 60      # seconds a cached verdict stays valid
+
+MISS = object()  # VerdictCache.get() result when nothing usable is cached
+
+# A check's decision to reject a request. ``label`` is the short, low-
+# cardinality reason used for metrics; ``reason`` is the detailed text for
+# waf_blocked.log; ``message`` is what the client gets with ``status``.
+Verdict = collections.namedtuple('Verdict', 'stage label reason status message')
+
+
+class BodyInspector:
+    """
+    Feeds a request body to ctx.body_scanner piece by piece as it is read.
+
+    Pieces are decoded as UTF-8 incrementally (a character split across two
+    pieces is decoded once both have arrived), lowercased and scanned; the raw
+    bytes are kept in ctx.body_chunks for forwarding. close() settles the scan
+    and sets ctx.body_preview to the decoded text.
+    """
+
+    def __init__(self, ctx, engine):
+        self.ctx = ctx
+        ctx.body_scanner = engine.scanner()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._preview = []
+
+    def add(self, chunk):
+        self.ctx.body_chunks.append(chunk)
+        text = self._decoder.decode(chunk)
+        self._preview.append(text)
+        self.ctx.body_scanner.feed(text.lower())
+
+    def close(self):
+        text = self._decoder.decode(b'', final=True)
+        self._preview.append(text)
+        self.ctx.body_scanner.feed(text.lower())
+        self.ctx.body_scanner.finish()
+        self.ctx.body_preview = ''.join(self._preview)
+
+
+def header_message(headers):
+    """
+    Return headers as an http.client.HTTPMessage, the type the proxy sees,
+    so lookups such as the User-Agent check are case-insensitive. headers
+    may be a dict (as in waf_requests.log) or a list of (name, value) pairs;
+    a message object is returned unchanged.
+    """
+    if hasattr(headers, 'get_all'):
+        return headers
+    message = http.client.HTTPMessage()
+    for name, value in (headers.items() if hasattr(headers, 'items') else headers):
+        message[str(name)] = str(value)
+    return message
+
+
+def context_from_record(record, engine, inspect_max_bytes=INSPECT_MAX_BYTES, chunk_size=BODY_CHUNK_SIZE):
+    """
+    Build a RequestContext from an in-memory record with the proxy's body handling.
+
+    record is a dict like a waf_requests.log entry (client_ip, method, path,
+    headers, body) or a (method, path, headers, body) tuple. Only POST bodies
+    are inspected, up to inspect_max_bytes, in chunk_size pieces. Headers are
+    converted with header_message(), so names match case-insensitively.
+    """
+    if isinstance(record, dict):
+        client_ip = record.get('client_ip') or '127.0.0.1'
+        method, path = record.get('method') or 'GET', record.get('path') or '/'
+        headers, body = record.get('headers') or {}, record.get('body')
+    else:
+        client_ip = '127.0.0.1'
+        method, path, headers, body = record
+    ctx = RequestContext(client_ip, method, path, header_message(headers))
+    inspector = BodyInspector(ctx, engine)
+    if method == 'POST' and body:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        body = body[:inspect_max_bytes]
+        for i in range(0, len(body), chunk_size):
+            inspector.add(body[i:i + chunk_size])
+    inspector.close()
+    return ctx
+
+
+def predict(model, features):
+    """Model prediction for one feature tuple (uses the LRU cache of a CachedPredictor)."""
+    if hasattr(model, 'predict_one'):
+        return model.predict_one(features)
+    return model.predict([list(features)])[0]
+
+
+def check_ml(ctx, model):
+    if model is None:
+        return None
+    if predict(model, ctx.ml_features) == 1:
+        return Verdict('ml', 'ml', "ML Model: Malicious", 403,
+                       "Request blocked by WAF ML model prediction.")
+    return None
+
+
+def check_user_agent(ctx, blocked_user_agents):
+    user_agent = ctx.user_agent
+    for bad_ua in blocked_user_agents:
+        if bad_ua in user_agent:
+            return Verdict('user_agent', 'user_agent', f"Blocked User-Agent: {user_agent}", 403,
+                           "Request blocked by WAF: Suspicious User-Agent detected.")
+    return None
+
+
+def check_blocklist(ctx, blocklist):
+    if blocklist.contains(ctx.client_ip):
+        return Verdict('blocklist', 'ui_blocklist', "UI Blocked", 403,
+                       "Request blocked by WAF: IP is blocked via dashboard.")
+    return None
+
+
+def check_country(country, allowed_countries, blocked_countries):
+    """Verdict for the client's ISO country code; unknown (None) is always allowed."""
+    if not country:
+        return None
+    if country in blocked_countries:
+        reason = f"Blocked Country: {country}"
+    elif allowed_countries and country not in allowed_countries:
+        reason = f"Not allowed Country: {country}"
+    else:
+        return None
+    return Verdict('geoip', 'geoip', reason, 403, f"Request blocked by WAF: Country {country} is not allowed.")
+
+
+def check_signatures(ctx):
+    """
+    Finish the signature scan: the path/query, then the headers the rule
+    set's header policy selects (the body was fed while it was read).
+    """
+    ctx.body_scanner.scan_headers(ctx.headers.items(), ctx.path_query)
+    label, signature = ctx.body_scanner.result()
+    if label:
+        reason = f"{label} ({signature})"
+        return Verdict('signatures', label, reason, 403, f"Request blocked by WAF: {reason} detected.")
+    return None
+
+
+# Checks DetectionPipeline can run, in the proxy's default order.
+CHECK_ORDER = ('blocklist', 'user_agent', 'geoip', 'ml', 'signatures')
+
+
+class DetectionPipeline:
+    """
+    The proxy's checks, runnable on in-memory records: the User-Agent filter,
+    ML prediction and the signature scan, plus the IP blocklist and country
+    rules when a blocklist or a GeoIP resolver is given. ``order`` lists the
+    stages to run (the proxy's stage order can be passed as is; stages that
+    are not checks here, such as rate_limit or log, are skipped). The rate
+    limit depends on arrival times and is left to the proxy. run() returns
+    the first Verdict, or None if the request passes.
+    """
+
+    def __init__(self, engine, blocked_user_agents, model=None, inspect_max_bytes=INSPECT_MAX_BYTES,
+                 blocklist=None, geoip=None, allowed_countries=(), blocked_countries=(), order=CHECK_ORDER):
+        self.engine = engine
+        self.blocked_user_agents = list(blocked_user_agents)
+        self.model = model
+        self.inspect_max_bytes = inspect_max_bytes
+        checks = {
+            'user_agent': lambda ctx: check_user_agent(ctx, self.blocked_user_agents),
+            'ml': lambda ctx: check_ml(ctx, self.model),
+            'signatures': check_signatures,
+        }
+        if blocklist is not None:
+            checks['blocklist'] = lambda ctx: check_blocklist(ctx, blocklist)
+        if geoip is not None and (allowed_countries or blocked_countries):
+            checks['geoip'] = lambda ctx: check_country(geoip.country(ctx.client_ip), allowed_countries,
+                                                        blocked_countries)
+        self.stages = [(name, checks[name]) for name in order if name in checks]
+
+    def prepare(self, record):
+        return context_from_record(record, self.engine, self.inspect_max_bytes)
+
+    def run(self, record):
+        """Check a record (or an already prepared RequestContext)."""
+        ctx = record if isinstance(record, RequestContext) else self.prepare(record)
+        for _, check in self.stages:
+            verdict = check(ctx)
+            if verdict is not None:
+                return verdict
+        return None
+
+
+def request_key(ctx):
+    """
+    Digest of everything the content checks look at: method, raw path and
+    query (the ML features and the decoded path both derive from it), every
+    header as a (lowercased name, value) pair and the inspected body. Header
+    names are part of the key because the rule set's HeaderPolicy decides
+    by name whether and against which signatures a value is scanned.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    parts = [ctx.method, ctx.path]
+    for name, value in ctx.headers.items():
+        parts.append(f"{name.lower()}\x01{value}")
+    parts.append('')
+    h.update('\x00'.join(parts).encode('utf-8', 'surrogateescape'))
+    for chunk in ctx.body_chunks:
+        h.update(chunk)
+    return h.digest()
+
+
+class VerdictCache:
+    """
+    Bounded LRU cache of content-check outcomes for identical requests.
+
+    Stores the Verdict that blocked a request, or None if it passed every
+    content check, for ``ttl`` seconds. Entries are only valid for the rule
+    set and model they were computed with: get() and put() take a ``rules``
+    token (e.g. the signature engine and ML model in use) and the whole cache
+    is flushed when it changes. Per-request checks such as the blocklist and
+    rate limit are never cached.
+    """
+
+    def __init__(self, maxsize=VERDICT_CACHE_SIZE, ttl=VERDICT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (expires_at, verdict)
+        self._rules = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def _check_rules(self, rules):
+        if rules != self._rules:
+            self._entries.clear()
+            self._rules = rules
+            self.flushes += 1
+
+    def get(self, key, rules):
+        now = time.monotonic()
+        with self._lock:
+            self._check_rules(rules)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return MISS
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, rules, verdict):
+        with self._lock:
+            self._check_rules(rules)
+            self._entries[key] = (time.monotonic() + self.ttl, verdict)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.flushes += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                "maxsize": self.maxsize, "flushes": self.flushes}
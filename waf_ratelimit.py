@@ -0,0 +1,266 @@
+# waf_ratelimit.py
+# Per-IP request rate limiting for the WAF proxy.
+
+import atexit
+import collections
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+SHARDS = 16
+MAX_TRACKED_IPS = 100000
+BUCKET_SLOTS = 8      # slots probed per IP in the shared table
+LOCK_STRIPES = 64     # process-shared locks guarding the shared table
+_SLOT_FIELDS = 4      # key, window index, current count, previous count
+_TABLE_MAGIC = 0x5741465254424C31  # "WAFRTBL1", first word of a named counter table
+
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding-window rate limiter with fixed-size state per IP.
+
+    Each IP keeps three numbers: the index of the current window and the
+    request counts for the current and previous windows. The rate is estimated
+    as ``previous * (fraction of previous window still in range) + current``,
+    the usual two-bucket approximation of a true sliding log, so a check is
+    O(1) no matter how many requests or IPs there are.
+
+    IPs are spread over ``shards`` independently locked LRU tables. Entries
+    that have been idle for two full windows carry no information and are
+    dropped lazily as new requests arrive; if a shard is still full (e.g.
+    during a spoofed-source flood) its least recently seen IP is evicted, so
+    memory never exceeds ``max_tracked`` entries.
+    """
+
+    def __init__(self, limit, window=60, shards=SHARDS, max_tracked=MAX_TRACKED_IPS):
+        self.limit = limit
+        self.window = window
+        self._shards = [(threading.Lock(), collections.OrderedDict()) for _ in range(shards)]
+        self._shard_capacity = max(1, max_tracked // shards)
+        self.evictions = 0
+
+    def __len__(self):
+        return sum(len(table) for _, table in self._shards)
+
+    def hit(self, ip, now=None):
+        """Record a request from ip and return True if it exceeds the limit."""
+        if now is None:
+            now = time.monotonic()
+        current = int(now // self.window)
+        lock, table = self._shards[hash(ip) % len(self._shards)]
+        with lock:
+            # Lazy expiry: the oldest entries sit at the front of the table.
+            for _ in range(2):
+                if not table:
+                    break
+                oldest = next(iter(table.values()))
+                if oldest[0] >= current - 1:
+                    break
+                table.popitem(last=False)
+            state = table.get(ip)
+            if state is None:
+                if len(table) >= self._shard_capacity:
+                    table.popitem(last=False)
+                    self.evictions += 1
+                state = table[ip] = [current, 0, 0]
+            else:
+                table.move_to_end(ip)
+                if state[0] != current:
+                    state[2] = state[1] if state[0] == current - 1 else 0
+                    state[1] = 0
+                    state[0] = current
+            state[1] += 1
+            elapsed = now / self.window - current
+            estimate = state[2] * (1.0 - elapsed) + state[1]
+        return estimate > self.limit
+
+
+def _ip_key(ip):
+    """Stable non-zero 63-bit key for ip (str hashes differ between processes)."""
+    digest = hashlib.blake2b(ip.encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+    return (int.from_bytes(digest, 'little') & 0x7FFFFFFFFFFFFFFF) or 1
+
+
+class _FileStripeLock:
+    """
+    One stripe of a lock file, locked with fcntl byte-range locks so that
+    unrelated processes can share it. fcntl locks are per process, so a
+    thread lock serialises the threads inside each process as well.
+    """
+
+    def __init__(self, fd, offset):
+        self._fd = fd
+        self._offset = offset
+        self._thread_lock = threading.Lock()
+
+    def __enter__(self):
+        import fcntl
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._offset)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def __exit__(self, *args):
+        import fcntl
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset)
+        finally:
+            self._thread_lock.release()
+
+
+def _open_named_table(name, words, window):
+    """
+    Create or attach the shared memory segment ``name`` holding ``words``
+    int64 counters after a 4-word header (magic, slot count, window, spare).
+    Returns (SharedMemory, memoryview of int64 over the whole segment).
+    """
+    from multiprocessing import shared_memory
+    size = (words + _SLOT_FIELDS) * 8
+
+    def open_segment(create):
+        try:
+            return shared_memory.SharedMemory(name=name, create=create, size=size if create else 0,
+                                              track=False)
+        except TypeError:
+            # Python < 3.13 has no track flag: stop the resource tracker from
+            # unlinking the segment when this process exits, since other WAF
+            # processes may still be using it.
+            shm = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            shm._waf_untracked = True
+            return shm
+
+    try:
+        shm = open_segment(True)
+        created = True
+    except FileExistsError:
+        shm = open_segment(False)
+        created = False
+    view = shm.buf[:size].cast('q') if shm.size >= size else None
+    if created:
+        view[1] = words
+        view[2] = int(window)
+        view[0] = _TABLE_MAGIC
+    else:
+        deadline = time.monotonic() + 2.0
+        while view is not None and view[0] != _TABLE_MAGIC and time.monotonic() < deadline:
+            time.sleep(0.01)  # the creating process is still writing the header
+        if view is None or view[0] != _TABLE_MAGIC or view[1] != words or view[2] != int(window):
+            if view is not None:
+                view.release()
+            shm.close()
+            raise ValueError(f"shared rate-limit table {name!r} exists with a different size or "
+                             f"window; remove it (e.g. /dev/shm/{name}) or pick another name")
+    return shm, view
+
+
+class SharedSlidingWindowRateLimiter:
+    """
+    The same two-bucket sliding window as SlidingWindowRateLimiter, with the
+    per-IP counters kept in shared memory so that several WAF processes
+    enforce one global limit instead of ``processes x limit``.
+
+    The table is a fixed array of int64 slots (key, window index, current
+    count, previous count). An IP hashes to a bucket of BUCKET_SLOTS slots; it
+    takes over an empty or expired slot there, or else the slot seen longest
+    ago. Buckets are guarded by ``lock_stripes`` locks. Memory is fixed at
+    ``max_tracked`` slots, 32 bytes each.
+
+    Without a ``name`` the table is anonymous shared memory guarded by
+    multiprocessing locks, shared by the workers forked from this process
+    (--workers). With a ``name`` it is a named multiprocessing.shared_memory
+    segment guarded by fcntl byte-range locks on ``<tmpdir>/<name>.lock``, so
+    independently started waf.py processes using the same name share it. A
+    named table outlives the processes using it; unlink() removes it.
+    """
+
+    def __init__(self, limit, window=60, max_tracked=MAX_TRACKED_IPS, lock_stripes=LOCK_STRIPES,
+                 name=None):
+        self.limit = limit
+        self.window = window
+        self.name = name
+        self._buckets = max(1, max_tracked // BUCKET_SLOTS)
+        words = self._buckets * BUCKET_SLOTS * _SLOT_FIELDS
+        self._shm = None
+        if name is None:
+            self._raw = multiprocessing.RawArray('q', words)
+            self._slots = memoryview(self._raw).cast('B').cast('q')
+            self._locks = [multiprocessing.Lock() for _ in range(lock_stripes)]
+        else:
+            self._shm, self._table = _open_named_table(name, words, window)
+            self._slots = self._table[_SLOT_FIELDS:]
+            lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+            self._lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._locks = [_FileStripeLock(self._lock_fd, i) for i in range(lock_stripes)]
+            # The segment can only be closed once no views of it are left, so
+            # release them before interpreter teardown gets to SharedMemory.__del__.
+            atexit.register(self.close)
+        self.evictions = 0  # per process
+
+    def close(self):
+        """Detach from a named table (the table itself stays; see unlink())."""
+        if self._shm is None or self._slots is None:
+            return
+        self._slots.release()
+        self._table.release()
+        self._slots = self._table = None
+        self._shm.close()
+        os.close(self._lock_fd)
+
+    def unlink(self):
+        """Remove a named table from the system (processes still attached keep their mapping)."""
+        if self._shm is None:
+            return
+        if getattr(self._shm, '_waf_untracked', False):
+            # SharedMemory.unlink() unregisters from the resource tracker;
+            # register first so the tracker has something to remove.
+            from multiprocessing import resource_tracker
+            resource_tracker.register(self._shm._name, 'shared_memory')
+        self._shm.unlink()
+
+    def __len__(self):
+        """Number of IPs with live (not yet expired) counters."""
+        current = int(time.monotonic() // self.window)
+        slots = self._slots
+        return sum(1 for i in range(0, len(slots), _SLOT_FIELDS)
+                   if slots[i] and slots[i + 1] >= current - 1)
+
+    def hit(self, ip, now=None):
+        """Record a request from ip and return True if it exceeds the limit."""
+        if now is None:
+            now = time.monotonic()  # CLOCK_MONOTONIC is system-wide, so workers agree on windows
+        current = int(now // self.window)
+        key = _ip_key(ip)
+        bucket = key % self._buckets
+        start = bucket * BUCKET_SLOTS * _SLOT_FIELDS
+        slots = self._slots
+        with self._locks[bucket % len(self._locks)]:
+            victim = victim_window = None
+            for i in range(start, start + BUCKET_SLOTS * _SLOT_FIELDS, _SLOT_FIELDS):
+                if slots[i] == key:
+                    break
+                slot_window = slots[i + 1] if slots[i] else -1
+                if victim is None or slot_window < victim_window:
+                    victim, victim_window = i, slot_window
+            else:
+                i = victim
+                if victim_window >= current - 1:
+                    self.evictions += 1
+                slots[i] = key
+                slots[i + 1] = current
+                slots[i + 2] = slots[i + 3] = 0
+            if slots[i + 1] != current:
+                slots[i + 3] = slots[i + 2] if slots[i + 1] == current - 1 else 0
+                slots[i + 2] = 0
+                slots[i + 1] = current
+            slots[i + 2] += 1
+            count, previous = slots[i + 2], slots[i + 3]
+        elapsed = now / self.window - current
+        estimate = previous * (1.0 - elapsed) + count
+        return estimate > self.limit
@@ -0,0 +1,154 @@
+# waf_replay.py
+# Offline replay of a JSON-lines request log (waf_requests.log format) through
+# the WAF's checks on a process pool, for testing rule and model changes
+# against historical traffic without sending it through the proxy.
+#
+# Used by `python waf.py --replay waf_requests.log`, which builds the
+# DetectionPipeline from the proxy's own configuration.
+
+import collections
+import json
+import multiprocessing
+import os
+import time
+
+CHUNK_LINES = 2000  # log lines handed to a worker at a time
+
+# The pipeline used by worker processes. It is set before the pool is forked,
+# so workers inherit the compiled signatures, the loaded model and the GeoIP
+# tables instead of unpickling or reloading them.
+_pipeline = None
+
+
+def read_chunks(path, chunk_lines=CHUNK_LINES):
+    """Yield (first line number, [lines]) for a log file, chunk_lines at a time."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        chunk, start = [], 1
+        for number, line in enumerate(f, 1):
+            if not chunk:
+                start = number
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield start, chunk
+                chunk = []
+        if chunk:
+            yield start, chunk
+
+
+def check_lines(start, lines, pipeline=None):
+    """
+    Run each log line through the pipeline. Returns (rows, counts): one
+    verdict row per checked line, and counts keyed 'allowed',
+    'blocked: <reason>', 'invalid' (not a JSON object) or 'error' (a check
+    raised).
+    """
+    pipeline = pipeline or _pipeline
+    rows = []
+    counts = collections.Counter()
+    for number, line in enumerate(lines, start):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            counts['invalid'] += 1
+            continue
+        try:
+            verdict = pipeline.run(record)
+        except Exception:
+            counts['error'] += 1
+            continue
+        row = {'line': number, 'client_ip': record.get('client_ip'), 'method': record.get('method'),
+               'path': record.get('path')}
+        if verdict is None:
+            row['action'] = 'allow'
+            counts['allowed'] += 1
+        else:
+            row.update(action='block', stage=verdict.stage, reason=verdict.reason, status=verdict.status)
+            counts[f'blocked: {verdict.label}'] += 1
+        rows.append(row)
+    return rows, counts
+
+
+def _check_chunk(chunk):
+    return check_lines(*chunk)
+
+
+def _fork_available():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def replay(pipeline, path, workers=None, output=None, chunk_lines=CHUNK_LINES):
+    """
+    Replay the log at path through pipeline on ``workers`` processes (default:
+    one per CPU; 1, or a platform without fork, runs in this process).
+    Verdict rows are written in log order to ``output`` as JSON lines if
+    given. Returns a summary dict with the aggregate counts.
+    """
+    global _pipeline
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and not _fork_available():
+        print("[WAF REPLAY] fork is not available here; replaying in one process")
+        workers = 1
+    counts = collections.Counter()
+    out = open(output, 'w') if output else None
+    started = time.perf_counter()
+
+    def emit(result):
+        rows, chunk_counts = result
+        counts.update(chunk_counts)
+        if out is not None:
+            out.writelines(json.dumps(row) + '\n' for row in rows)
+
+    try:
+        if workers == 1:
+            for chunk in read_chunks(path, chunk_lines):
+                emit(check_lines(*chunk, pipeline=pipeline))
+        else:
+            _pipeline = pipeline
+            try:
+                with multiprocessing.get_context('fork').Pool(workers) as pool:
+                    # Bounded number of chunks in flight, so a huge log is
+                    # streamed rather than queued into memory all at once.
+                    pending = collections.deque()
+                    for chunk in read_chunks(path, chunk_lines):
+                        pending.append(pool.apply_async(_check_chunk, (chunk,)))
+                        if len(pending) >= workers * 4:
+                            emit(pending.popleft().get())
+                    while pending:
+                        emit(pending.popleft().get())
+            finally:
+                _pipeline = None
+    finally:
+        if out is not None:
+            out.close()
+    seconds = time.perf_counter() - started
+    blocked = {key[len('blocked: '):]: n for key, n in counts.items() if key.startswith('blocked: ')}
+    checked = counts['allowed'] + sum(blocked.values())
+    return {
+        'log': path,
+        'workers': workers,
+        'requests': checked,
+        'allowed': counts['allowed'],
+        'blocked': sum(blocked.values()),
+        'invalid': counts['invalid'],
+        'errors': counts['error'],
+        'blocked_by_reason': dict(sorted(blocked.items(), key=lambda item: -item[1])),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(checked / seconds, 1) if seconds else None,
+    }
+
+
+def print_summary(summary):
+    print(f"Replayed {summary['requests']} requests from {summary['log']} in {summary['seconds']}s "
+          f"({summary['requests_per_second']} req/s, {summary['workers']} workers)")
+    print(f"{summary['allowed']:>10}  allowed")
+    print(f"{summary['blocked']:>10}  blocked")
+    for reason, n in summary['blocked_by_reason'].items():
+        print(f"{n:>10}    {reason}")
+    if summary['invalid']:
+        print(f"{summary['invalid']:>10}  invalid lines skipped")
+    if summary['errors']:
+        print(f"{summary['errors']:>10}  requests skipped because a check failed")
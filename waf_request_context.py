@@ -0,0 +1,70 @@
+# waf_request_context.py
+# Parse-once view of an incoming request, shared by every WAF check.
+
+import urllib.parse
+
+SQL_KEYWORDS = ['select', 'union', 'insert', 'drop', 'update', 'delete', 'or 1=1', 'and 1=1']
+
+
+class RequestContext:
+    """
+    Everything the WAF checks need to know about one request.
+
+    Derived values (the decoded path/query, the lowercased User-Agent, the ML
+    feature vector) are computed on first use and then cached, so each is
+    built at most once per request no matter how many stages read it, and not
+    at all if an earlier stage already blocked.
+
+    The body is filled in by the proxy as it reads it (see
+    WAFProxyHandler.read_body_prefix): ``body_scanner`` has already scanned the
+    inspected part, ``body_chunks`` holds the raw bytes for forwarding and
+    ``body_remaining`` counts uninspected bytes still on the socket.
+    """
+
+    __slots__ = (
+        'client_ip', 'method', 'path', 'headers',
+        'body_scanner', 'body_chunks', 'body_remaining', 'body_preview',
+        '_path_query', '_user_agent', '_ml_features',
+    )
+
+    def __init__(self, client_ip, method, path, headers):
+        self.client_ip = client_ip
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body_scanner = None
+        self.body_chunks = []
+        self.body_remaining = 0
+        self.body_preview = ''
+        self._path_query = None
+        self._user_agent = None
+        self._ml_features = None
+
+    @property
+    def path_query(self):
+        """Unquoted, lowercased path plus '?query' (if any), as the signature scan sees it."""
+        if self._path_query is None:
+            parsed_url = urllib.parse.urlparse(self.path)
+            full_path = urllib.parse.unquote(parsed_url.path).lower()
+            query_str = urllib.parse.unquote(parsed_url.query).lower()
+            self._path_query = full_path + '?' + query_str if query_str else full_path
+        return self._path_query
+
+    @property
+    def user_agent(self):
+        """Lowercased User-Agent header ('' if absent)."""
+        if self._user_agent is None:
+            self._user_agent = self.headers.get('User-Agent', '').lower()
+        return self._user_agent
+
+    @property
+    def ml_features(self):
+        """(path_len, num_special, num_digits, has_sql_keywords) of the raw path."""
+        if self._ml_features is None:
+            path = self.path
+            num_alnum = sum(map(str.isalnum, path))
+            num_digits = sum(map(str.isdigit, path))
+            path_lower = path.lower()
+            has_sql_keywords = int(any(kw in path_lower for kw in SQL_KEYWORDS))
+            self._ml_features = (len(path), len(path) - num_alnum, num_digits, has_sql_keywords)
+        return self._ml_features
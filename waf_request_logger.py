@@ -1,8 +1,130 @@
 # waf_request_logger.py
 # Logs all incoming WAF requests for ML analysis
+import atexit
 import datetime
 import json
+import os
+import queue
 import threading
+import time
+
+REQUEST_LOG_FILE = "waf_requests.log"
+
+MAX_QUEUE = 10000       # records waiting to be written before new ones are dropped
+BATCH_SIZE = 512        # records written per file append
+FLUSH_INTERVAL = 0.5    # seconds a record may wait before its batch is written
+DROP_REPORT_INTERVAL = 10  # seconds between "dropped N records" warnings
+
+
+class BatchedLogWriter:
+    """
+    Appends log records to a file from a single background thread.
+
+    write() never blocks the request: it puts the record on a bounded queue
+    and, if the queue is full, drops it and counts the drop. The writer thread
+    takes up to BATCH_SIZE records at a time (waiting at most FLUSH_INTERVAL for
+    the first one), formats them, and appends the batch with one write, so lines
+    from concurrent requests never interleave. Dropped records are reported on
+    stdout at most every DROP_REPORT_INTERVAL seconds and counted in ``dropped``.
+
+    ``formatter`` turns a queued record into a line (with trailing newline); it
+    runs on the writer thread, so callers can queue cheap tuples or dicts.
+    """
+
+    def __init__(self, path, formatter=str, max_queue=MAX_QUEUE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.formatter = formatter
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._last_report = 0.0
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        atexit.register(self.flush)
+
+    def _ensure_started(self):
+        # Started lazily, and again in a forked child, whose copy of the
+        # parent's writer thread does not exist.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            thread = threading.Thread(target=self._run, name=f"log-writer:{self.path}", daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def write(self, record):
+        """Queue a record; returns False if it was dropped because the queue is full."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout=5.0):
+        """Wait (up to timeout seconds) until everything queued so far is on disk."""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self):
+        pending = self._queue.qsize() if self._pid == os.getpid() else 0
+        return {"written": self.written, "dropped": self.dropped, "pending": pending}
+
+    def _run(self):
+        q = self._queue
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                try:
+                    lines.append(self.formatter(record))
+                except Exception as e:
+                    print(f"[WAF LOGGING ERROR] {e}")
+            try:
+                with open(self.path, "a") as f:
+                    f.write("".join(lines))
+                self.written += len(lines)
+            except OSError as e:
+                print(f"[WAF LOGGING ERROR] {e}")
+            for _ in batch:
+                q.task_done()
+            self._report_drops()
+
+    def _report_drops(self):
+        now = time.monotonic()
+        if self.dropped != self._reported_dropped and now - self._last_report >= DROP_REPORT_INTERVAL:
+            print(f"[WAF LOGGING] dropped {self.dropped - self._reported_dropped} records for {self.path} (queue full)")
+            self._reported_dropped = self.dropped
+            self._last_report = now
+
+
+def _format_request(log_entry):
+    return json.dumps(log_entry) + "\n"
+
+
+request_log_writer = BatchedLogWriter(REQUEST_LOG_FILE, formatter=_format_request)
+
 
 def log_request(client_ip, method, path, headers, body):
     log_entry = {
@@ -13,6 +135,4 @@ def log_request(client_ip, method, path, headers, body):
         "headers": dict(headers),
         "body": body
     }
-    with threading.Lock():
-        with open("waf_requests.log", "a") as f:
-            f.write(json.dumps(log_entry) + "\n")
+    request_log_writer.write(log_entry)
@@ -0,0 +1,299 @@
+# waf_response_cache.py
+# In-proxy micro-cache of backend responses to safe GET requests.
+#
+# Only responses the backend marks as cacheable are stored: an explicit
+# lifetime from Cache-Control (s-maxage / max-age) or Expires, no no-store,
+# no-cache or private, no Set-Cookie and no "Vary: *". Requests carrying
+# credentials (Authorization, Cookie) or asking for a fresh copy (Cache-Control
+# no-cache / no-store / max-age=0, Pragma: no-cache) bypass the cache. Cache
+# hits are served by the proxy after the request has passed every WAF check,
+# so only the backend is spared, not the inspection.
+
+import collections
+import email.utils
+import threading
+import time
+
+MAX_BYTES = 64 * 1024 * 1024     # total body bytes kept
+MAX_ENTRY_BYTES = 1024 * 1024    # larger responses are relayed but not stored
+MAX_TTL = 60                     # upper bound on any entry's lifetime, seconds
+FLIGHT_TIMEOUT = 30              # seconds a request waits for an identical one already being fetched
+PASS_TTL = 10                    # seconds a key whose response was not storable skips the waiting
+MAX_PASS_KEYS = 10000            # keys remembered as not storable
+CACHEABLE_STATUSES = frozenset((200, 203, 204, 300, 301, 308, 404, 410))
+ENTRY_OVERHEAD = 512             # bytes charged per entry for its key and headers
+
+
+def cache_control(values):
+    """Parse Cache-Control header values into {directive: argument or None}."""
+    directives = {}
+    for value in values:
+        for part in value.split(','):
+            name, _, arg = part.strip().partition('=')
+            if name:
+                directives[name.lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def _header_values(headers, name):
+    return [value for header, value in headers if header.lower() == name]
+
+
+def freshness_lifetime(status, headers, now=None):
+    """
+    Seconds a response with these headers (a list of (name, value)) may be
+    served from a shared cache, or 0 if it must not be stored.
+    """
+    if status not in CACHEABLE_STATUSES:
+        return 0
+    directives = cache_control(_header_values(headers, 'cache-control'))
+    if {'no-store', 'no-cache', 'private'} & directives.keys():
+        return 0
+    if _header_values(headers, 'set-cookie'):
+        return 0
+    if any(v.strip() == '*' for value in _header_values(headers, 'vary') for v in value.split(',')):
+        return 0
+    lifetime = None
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                lifetime = int(directives[name])
+            except (TypeError, ValueError):
+                return 0
+            break
+    if lifetime is None:
+        expires = _header_values(headers, 'expires')
+        if not expires:
+            return 0
+        try:
+            expires_at = email.utils.parsedate_to_datetime(expires[0]).timestamp()
+        except (TypeError, ValueError):
+            return 0  # invalid dates, e.g. "0", mean already expired
+        date = _header_values(headers, 'date')
+        try:
+            date_at = email.utils.parsedate_to_datetime(date[0]).timestamp() if date else None
+        except (TypeError, ValueError):
+            date_at = None
+        lifetime = expires_at - (date_at if date_at is not None else (time.time() if now is None else now))
+    try:
+        age = int(_header_values(headers, 'age')[0])
+    except (IndexError, ValueError):
+        age = 0
+    return max(0, lifetime - age)
+
+
+def cacheable_request(method, headers):
+    """True if a request may be answered from, and its response stored in, the cache."""
+    if method != 'GET' or 'Authorization' in headers or 'Cookie' in headers:
+        return False
+    directives = cache_control(headers.get_all('Cache-Control') or ())
+    if 'no-cache' in directives or 'no-store' in directives or directives.get('max-age', 'x') == '0':
+        return False
+    return 'no-cache' not in (headers.get('Pragma') or '').lower()
+
+
+class CachedResponse:
+    __slots__ = ('status', 'headers', 'body', 'vary', 'stored_at', 'expires_at', 'size')
+
+    def __init__(self, status, headers, body, vary, stored_at, expires_at):
+        self.status = status
+        self.headers = headers      # [(name, value)] without hop-by-hop headers or Age
+        self.body = body
+        self.vary = vary            # ((header, request value), ...) the response varies on
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.size = len(body) + ENTRY_OVERHEAD
+
+    def age(self, now=None):
+        return int((time.monotonic() if now is None else now) - self.stored_at)
+
+
+class Flight:
+    """
+    One upstream fetch that identical concurrent requests wait on; also
+    records the response. As soon as the response turns out not to be
+    storable (its headers give it no lifetime, or its body outgrows
+    ``max_bytes``) the flight is abandoned: recording stops and the waiting
+    requests are released to fetch for themselves instead of waiting for the
+    whole body to be relayed.
+    """
+
+    def __init__(self, key, request_headers, max_bytes, on_abandon):
+        self.key = key
+        self.request_headers = request_headers
+        self.max_bytes = max_bytes
+        self.done = threading.Event()
+        self.status = None
+        self.headers = None
+        self.ttl = 0
+        self.chunks = []
+        self.size = 0
+        self.complete = False
+        self._on_abandon = on_abandon
+
+    def start(self, status, headers):
+        self.status = status
+        self.headers = headers
+        self.ttl = freshness_lifetime(status, headers)
+        if self.ttl <= 0:
+            self.abandon()
+
+    def abandon(self):
+        if self.chunks is not None:
+            self.chunks = None
+            self._on_abandon(self)
+
+    def tee(self, write):
+        """Wrap write() so the body is also recorded, up to max_bytes."""
+        def tee_write(data):
+            write(data)
+            if self.chunks is not None:
+                self.size += len(data)
+                if self.size > self.max_bytes:
+                    self.abandon()  # too big to store; keep relaying
+                else:
+                    self.chunks.append(bytes(data))
+        return tee_write
+
+
+class ResponseCache:
+    """
+    LRU cache of backend responses, bounded by total body bytes.
+
+    Entries are keyed by (Host, path and query) and live for the lifetime
+    the backend gave them, capped at ``max_ttl``. One variant is kept per
+    key: if the response has a Vary header, the request header values it
+    names are stored with it and a request with different values is a miss.
+
+    lookup() also collapses identical misses ("single flight"): the first
+    request for a key gets a Flight and fetches from the backend, recording
+    the response as it relays it; requests for the same key that arrive
+    meanwhile wait (up to ``flight_timeout``) for finish() and are then
+    answered from the cache. Waiters are released as soon as the response
+    turns out not to be storable and go to the backend themselves; the key
+    then skips single flight for PASS_TTL seconds, so later requests for it
+    are not held up waiting for a response that cannot be shared.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, max_entry_bytes=MAX_ENTRY_BYTES, max_ttl=MAX_TTL,
+                 flight_timeout=FLIGHT_TIMEOUT):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_ttl = max_ttl
+        self.flight_timeout = flight_timeout
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key -> CachedResponse
+        self._flights = {}
+        self._pass = collections.OrderedDict()  # key -> monotonic time until which it skips single flight
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fresh(self, key, headers, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            self._remove(key)
+            return None
+        if any(headers.get(name) != value for name, value in entry.vary):
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    def lookup(self, key, headers):
+        """
+        Return (entry, None) on a hit. On a miss return (None, flight) if this
+        request should fetch and then call finish(flight), or (None, None) if
+        it should fetch without storing (an identical fetch just failed to
+        produce a cacheable response).
+        """
+        with self._lock:
+            entry = self._fresh(key, headers, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry, None
+            flight = self._flights.get(key)
+            if flight is None:
+                self.misses += 1
+                passing = self._pass.get(key)
+                if passing is not None:
+                    if passing > time.monotonic():
+                        return None, None
+                    del self._pass[key]
+                flight = self._flights[key] = Flight(key, headers, self.max_entry_bytes, self._abandoned)
+                return None, flight
+            self.coalesced += 1
+        flight.done.wait(self.flight_timeout)
+        with self._lock:
+            entry = self._fresh(key, headers, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry, None
+            self.misses += 1
+        return None, None
+
+    def finish(self, flight):
+        """End a fetch started by lookup(): store the response if it is complete and cacheable, then wake waiters."""
+        try:
+            if flight.complete and flight.chunks is not None:
+                self._store(flight)
+        finally:
+            self._release(flight)
+
+    def _abandoned(self, flight):
+        with self._lock:
+            self._pass[flight.key] = time.monotonic() + PASS_TTL
+            self._pass.move_to_end(flight.key)
+            while len(self._pass) > MAX_PASS_KEYS:
+                self._pass.popitem(last=False)
+        self._release(flight)
+
+    def _release(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.done.set()
+
+    def _store(self, flight):
+        headers = [(name, value) for name, value in flight.headers if name.lower() != 'age']
+        ttl = min(flight.ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        vary = tuple((name, flight.request_headers.get(name))
+                     for value in _header_values(flight.headers, 'vary')
+                     for name in (v.strip() for v in value.split(',')) if name)
+        now = time.monotonic()
+        entry = CachedResponse(flight.status, headers, b''.join(flight.chunks), vary, now, now + ttl)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if flight.key in self._entries:
+                self._remove(flight.key)
+            self._entries[flight.key] = entry
+            self._pass.pop(flight.key, None)
+            self.bytes += entry.size
+            self.stores += 1
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pass.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "stores": self.stores,
+                "evictions": self.evictions, "entries": len(self._entries), "bytes": self.bytes}
@@ -0,0 +1,199 @@
+# waf_rules.py
+# The WAF's signature rule set, kept in waf_rules.json instead of waf.py.
+#
+# The proxy watches the file from a background thread: when it changes, the new
+# rules are parsed and compiled into a SignatureEngine off the request path and
+# then swapped in with a single assignment. Requests already being inspected
+# finish with the engine they started with. A file that fails to parse or
+# compile is reported and the previous rules stay in effect.
+#
+# File format:
+#   {"version": 3,
+#    "groups": [{"label": "SQL Injection", "mode": "word",
+#                "signatures": ["UNION SELECT", {"signature": "--", "mode": "substring"}]},
+#               ...]}
+# Groups are in priority order, and so are the signatures inside each group.
+# "mode" is "word" (whole word or exact phrase) or "substring" (plain
+# containment); a signature given as an object can override its group's mode.
+# An optional "headers" list sets which request headers are scanned, against
+# which groups and up to what length (see waf_signatures.HeaderPolicy), e.g.
+#   "headers": [{"names": ["accept", "sec-fetch-*"], "scan": false},
+#               {"names": ["referer"], "groups": ["SQL Injection"], "max_length": 2048},
+#               {"names": ["*"], "max_length": 4096}]
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from waf_signatures import SignatureEngine, SUBSTRING, WORD
+
+RULES_FILE = 'waf_rules.json'
+CHECK_INTERVAL = 2.0  # seconds between stat() calls on the rules file
+MODES = {'word': WORD, 'substring': SUBSTRING}
+
+
+def read_rules(path=RULES_FILE):
+    """Return (data, digest) for a rules file; digest is a short SHA-256 of its bytes."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return json.loads(raw), hashlib.sha256(raw).hexdigest()[:12]
+
+
+def rule_entries(data):
+    """
+    Flatten parsed rules into SignatureEngine entries, (label, signature, mode)
+    in priority order. Raises ValueError if the structure is not valid.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('groups'), list):
+        raise ValueError("rules must be an object with a 'groups' list")
+    if not isinstance(data.get('version', 0), int):
+        raise ValueError("'version' must be an integer")
+    entries = []
+    for group in data['groups']:
+        label = group.get('label') if isinstance(group, dict) else None
+        if not isinstance(label, str) or not label:
+            raise ValueError(f"group without a label: {group!r}")
+        group_mode = group.get('mode', 'word')
+        if group_mode not in MODES:
+            raise ValueError(f"{label}: unknown mode {group_mode!r}")
+        for item in group.get('signatures', []):
+            if isinstance(item, dict):
+                signature, mode = item.get('signature'), item.get('mode', group_mode)
+            else:
+                signature, mode = item, group_mode
+            if not isinstance(signature, str) or mode not in MODES:
+                raise ValueError(f"{label}: invalid signature entry {item!r}")
+            entries.append((label, signature, MODES[mode]))
+    return entries
+
+
+def compile_rules(data):
+    headers = data.get('headers')
+    if headers is not None and not isinstance(headers, list):
+        raise ValueError("'headers' must be a list of header rules")
+    return SignatureEngine(rule_entries(data), header_rules=headers)
+
+
+def write_rules(path, data):
+    """Write rules atomically (temp file + rename), so a watching proxy never reads half a file."""
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    os.replace(tmp, path)
+
+
+def add_signature(signature, label, path=RULES_FILE, mode=None):
+    """
+    Append signature to the group named label and bump the rule-set version.
+    Returns False if the group does not exist or already has the signature.
+    """
+    data, _ = read_rules(path)
+    for group in data.get('groups', []):
+        if group.get('label') != label:
+            continue
+        existing = [s.get('signature') if isinstance(s, dict) else s for s in group.get('signatures', [])]
+        if signature in existing:
+            return False
+        group.setdefault('signatures', []).append(signature if mode is None else {'signature': signature, 'mode': mode})
+        data['version'] = int(data.get('version', 0)) + 1
+        compile_rules(data)  # refuse to write a file the proxy would reject
+        write_rules(path, data)
+        return True
+    return False
+
+
+class RuleSet:
+    """
+    The active SignatureEngine plus where it came from.
+
+    ``engine`` always holds a fully compiled engine; readers take the
+    reference once per request and never see a partly built one. ``version``
+    is the file's "version" field and ``digest`` identifies its exact
+    contents. start() runs a watcher thread that calls reload_if_changed()
+    every ``check_interval`` seconds; the file is only re-read when its mtime,
+    size or inode changes.
+    """
+
+    def __init__(self, path=RULES_FILE, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.engine = SignatureEngine([])
+        self.version = None
+        self.digest = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.errors = 0
+        self._file_sig = None
+        self._lock = threading.Lock()
+        self._stop = None
+        self.reload_if_changed(force=True)
+
+    @property
+    def loaded(self):
+        return self.digest is not None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            return None
+
+    def reload_if_changed(self, force=False):
+        """Recompile and swap in the rules if the file changed; True if new rules were installed."""
+        with self._lock:
+            sig = self._stat()
+            if sig == self._file_sig and not force:
+                return False
+            self._file_sig = sig
+            if sig is None:
+                self.errors += 1
+                print(f"[WAF RULES] rules file {self.path} not found; keeping current rules")
+                return False
+            try:
+                data, digest = read_rules(self.path)
+                if digest == self.digest:
+                    return False  # touched but unchanged
+                engine = compile_rules(data)
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                print(f"[WAF RULES] failed to load {self.path}: {e}; keeping current rules")
+                return False
+            first = not self.loaded
+            self.engine = engine
+            self.version = data.get('version', 0)
+            self.digest = digest
+            self.loaded_at = time.time()
+            if not first:
+                self.reloads += 1
+            print(f"[*] Signature rules {'loaded' if first else 'reloaded'}: version {self.version} "
+                  f"({digest}), {len(engine)} signatures")
+            return True
+
+    def start(self):
+        """Watch the rules file from a daemon thread (call once per process, after any fork)."""
+        if self._stop is not None:
+            return
+        self._stop = threading.Event()
+        stop = self._stop
+
+        def watch():
+            while not stop.wait(self.check_interval):
+                try:
+                    self.reload_if_changed()
+                except Exception as e:
+                    print(f"[WAF RULES] watcher error: {e}")
+
+        threading.Thread(target=watch, name='waf-rules-watcher', daemon=True).start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def stats(self):
+        return {"version": self.version, "digest": self.digest, "signatures": len(self.engine),
+                "reloads": self.reloads, "errors": self.errors, "loaded_at": self.loaded_at}
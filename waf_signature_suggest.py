@@ -10,23 +10,20 @@ from collections import Counter
 
 import os
 
+import waf_rules
+
 LOG_FILE = 'waf_blocked.log'
 
-# Existing signatures (copy from waf.py)
-EXISTING_SIGNATURES = set([
-    # SQL Injection
-    "' OR '1'='1", "UNION SELECT", "SELECT * FROM", "DROP TABLE", "DELETE FROM", "INSERT INTO", "UPDATE", "CAST(", "CHAR(", "CONVERT(", "INFORMATION_SCHEMA", "waitfor delay", "benchmark(", "sleep(", "pg_sleep(", "substring(", "ascii(", "1=1", "1=2", "OR 1=1", "AND 1=1", "--", "#", "'--",
-    # XSS
-    "<script>", "javascript:", "onerror=", "onload=", "onmouseover=", "onfocus=", "onblur=", "onclick=", "onreadystatechange=", "onmousemove=", "alert(", "prompt(", "confirm(", "document.cookie", "document.domain", "eval(", "src=", "<img", "<img>", "<body", "<iframe", "<svg", "<a href",
-    # Directory Traversal
-    "../", "..%2f", "..%5c", "..\\.", "..\\",
-    # Command Injection
-    "ls", "cat", "id", "whoami", "pwd", "ping", "nc", "sh", "bash", "cmd.exe",
-    # LFI
-    "/etc/passwd", "/etc/password", "/etc/shadow", "/etc/hosts", "/proc/self/cmdline", "c:\\boot.ini", "c:\\windows\\win.ini", "file://", "php://filter",
-    # HTTP Splitting
-    "\n", "\r", "\r\n"
-])
+# Existing signatures and their groups, read from the WAF rules file
+RULES_FILE = waf_rules.RULES_FILE
+
+def load_existing_signatures(path=RULES_FILE):
+    data, _ = waf_rules.read_rules(path)
+    return {signature.lower() for _, signature, _ in waf_rules.rule_entries(data)}
+
+def load_signature_groups(path=RULES_FILE):
+    data, _ = waf_rules.read_rules(path)
+    return [group['label'] for group in data.get('groups', [])]
 
 # Helper: extract suspicious tokens from a string
 TOKEN_RE = re.compile(r"[\w\-/\.\:\'\"]{5,}")
@@ -40,34 +37,18 @@ COMMON_HEADERS = set([
     'gecko/20100101', 'firefox/128.0', 'text/html', 'application/xhtml', 'application/xml'
 ])
 
-# Signature list mapping for waf.py
-SIGNATURE_LISTS = {
-    '1': ('SQL_INJECTION_SIGNATURE', "SQL Injection"),
-    '2': ('XSS_SIGNATURES', "Cross-Site Scripting (XSS)"),
-    '3': ('DIRECTORY_TRAVERSAL_SIGNATURES', "Directory Traversal"),
-    '4': ('COMMAND_INJECTION_SIGNATURES', "Command Injection"),
-    '5': ('LFI_SIGNATURES', "Local File Inclusion (LFI)"),
-    '6': ('HTTP_SPLITTING_SIGNATURES', "HTTP Response Splitting")
-}
-
-def add_signature_to_waf(signature, list_name):
-    waf_path = 'waf.py'
-    with open(waf_path, 'r') as f:
-        lines = f.readlines()
-    # Find the list definition
-    for i, line in enumerate(lines):
-        if line.strip().startswith(list_name + ' = ['):
-            # Find the closing bracket
-            for j in range(i+1, len(lines)):
-                if lines[j].strip().startswith(']'):
-                    # Insert before closing bracket
-                    lines.insert(j, f'    "{signature}",\n')
-                    with open(waf_path, 'w') as wf:
-                        wf.writelines(lines)
-                    print(f"Added '{signature}' to {list_name} in waf.py.")
-                    return True
-    print(f"Could not find {list_name} in waf.py.")
-    return False
+def add_signature_to_rules(signature, label):
+    """Append signature to a group in the rules file; a running waf.py picks it up without a restart."""
+    try:
+        added = waf_rules.add_signature(signature, label, path=RULES_FILE)
+    except (OSError, ValueError) as e:
+        print(f"Could not update {RULES_FILE}: {e}")
+        return False
+    if added:
+        print(f"Added '{signature}' to {label} in {RULES_FILE}.")
+    else:
+        print(f"'{signature}' is already in {label}, or {label} is not in {RULES_FILE}.")
+    return added
 
 # List of common HTTP header names/values to ignore
 COMMON_HEADERS = set([
@@ -95,25 +76,26 @@ def main():
     # Filter out existing signatures and common headers, and only suggest if token contains suspicious keyword
     def is_suspicious(token):
         return any(kw in token for kw in SUSPICIOUS_KEYWORDS)
+    existing = load_existing_signatures()
     suggestions = [token for token, count in token_counter.items()
-                   if token not in EXISTING_SIGNATURES and token not in COMMON_HEADERS and count > 1 and is_suspicious(token)]
+                   if token not in existing and token not in COMMON_HEADERS and count > 1 and is_suspicious(token)]
     if not suggestions:
         print("No new signature suggestions found.")
         return
+    groups = load_signature_groups()
     print("Suggested new signatures (appeared more than once and not already in list):")
     for token in suggestions:
         print(f"  - {token}")
-        answer = input(f"Add '{token}' directly to waf.py signature lists? (y/n): ").strip().lower()
+        answer = input(f"Add '{token}' to the WAF rules ({RULES_FILE})? (y/n): ").strip().lower()
         if answer == 'y':
             print("Which attack type should this signature be added to?")
-            for k, v in SIGNATURE_LISTS.items():
-                print(f"  {k}: {v[1]}")
-            choice = input("Enter number (1-6): ").strip()
-            if choice in SIGNATURE_LISTS:
-                list_name = SIGNATURE_LISTS[choice][0]
-                success = add_signature_to_waf(token, list_name)
+            for i, label in enumerate(groups, 1):
+                print(f"  {i}: {label}")
+            choice = input(f"Enter number (1-{len(groups)}): ").strip()
+            if choice.isdigit() and 1 <= int(choice) <= len(groups):
+                success = add_signature_to_rules(token, groups[int(choice) - 1])
                 if not success:
-                    print(f"Failed to add '{token}' to waf.py.")
+                    print(f"Failed to add '{token}' to {RULES_FILE}.")
             else:
                 print("Invalid choice. Skipped.")
         else:
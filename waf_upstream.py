@@ -0,0 +1,177 @@
+# waf_upstream.py
+# Pool of persistent HTTP/1.1 connections from the WAF to the protected backend.
+
+import collections
+import http.client
+import threading
+import time
+
+POOL_SIZE = 32       # idle keep-alive connections kept open to the backend
+IDLE_TIMEOUT = 30    # seconds an idle connection may sit in the pool
+CONNECT_TIMEOUT = 30 # socket timeout for connect and each read from the backend
+RELAY_BUFFER_SIZE = 64 * 1024  # per-thread buffer reused for relaying response bodies
+
+# Hop-by-hop headers (RFC 7230 section 6.1) describe a single connection and
+# must not be forwarded by a proxy in either direction.
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+
+# Errors that mean a reused keep-alive connection was closed by the backend
+# while it sat idle. RemoteDisconnected is a ConnectionResetError.
+_STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError,
+                            ConnectionAbortedError, http.client.BadStatusLine)
+
+# Methods that may be sent again when it is unclear whether the backend got
+# them (RFC 9110 section 9.2.2).
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'))
+
+
+_relay_buffers = threading.local()
+
+
+def relay_body(response, write, buffer_size=RELAY_BUFFER_SIZE):
+    """
+    Stream an http.client response body to write() as it arrives and return
+    the number of bytes relayed.
+
+    Plain bodies (Content-Length or close-delimited) are read with readinto1()
+    into a buffer that each thread allocates once and reuses, and passed on as
+    memoryview slices, so there is no per-read allocation and no read blocks
+    waiting for a full buffer: whatever the backend has sent is forwarded
+    immediately. Chunked bodies are de-chunked by http.client's read1(), one
+    chunk (or less) at a time. Either way the response ends up fully read and
+    closed, so release() can return the connection to the pool.
+    """
+    if response.isclosed():
+        return 0
+    if response.chunked:
+        total = 0
+        while True:
+            data = response.read1(buffer_size)
+            if not data:
+                return total
+            write(data)
+            total += len(data)
+    buf = getattr(_relay_buffers, 'buf', None)
+    if buf is None or len(buf) != buffer_size:
+        buf = _relay_buffers.buf = memoryview(bytearray(buffer_size))
+    # Same bookkeeping as HTTPResponse.read1(), minus the bytes object it
+    # allocates per call: read from the underlying buffered socket file and
+    # keep response.length (bytes still expected, None if unknown) current.
+    fp = response.fp
+    total = 0
+    while True:
+        want = buffer_size if response.length is None else min(buffer_size, response.length)
+        if want <= 0:
+            break
+        n = fp.readinto1(buf[:want])
+        if not n:
+            if response.length:
+                raise http.client.IncompleteRead(b'', response.length)
+            break
+        if response.length is not None:
+            response.length -= n
+        write(buf[:n])
+        total += n
+    response.read()  # nothing left; lets http.client mark the response closed
+    return total
+
+
+def forward_headers(headers):
+    """Return request headers safe to send upstream (hop-by-hop headers removed)."""
+    drop = set(HOP_BY_HOP_HEADERS)
+    for token in headers.get('Connection', '').split(','):
+        drop.add(token.strip().lower())
+    return {k: v for k, v in headers.items() if k.lower() not in drop}
+
+
+class UpstreamPool:
+    """
+    Thread-safe pool of keep-alive HTTPConnections to one backend.
+
+    request() hands out an idle connection when one is available and opens a
+    new one otherwise; release() puts it back if the response was read to the
+    end and the backend did not ask to close. At most ``size`` idle connections
+    are kept, and any idle longer than ``idle_timeout`` seconds are discarded.
+    """
+
+    def __init__(self, host, port, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT,
+                 timeout=CONNECT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = collections.deque()  # (conn, released_at), newest on the right
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+
+    def _acquire(self):
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                stale.append(self._idle.popleft()[0])
+            if self._idle:
+                conn = self._idle.pop()[0]
+                self.reuses += 1
+            else:
+                self.connects += 1
+        for old in stale:
+            old.close()
+        if conn is not None:
+            return conn, True
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request upstream and return (conn, response).
+
+        A reused connection that turns out to be dead is replaced with a fresh
+        one and the request is retried, as long as the body can be sent again
+        (None, bytes, or a list of byte chunks; not a one-shot iterator). If
+        the connection fails while sending, the backend had closed it and
+        never saw the request, so any method is retried. If it fails while
+        waiting for the response, the backend may already have acted on the
+        request, so only IDEMPOTENT_METHODS are retried and anything else
+        (e.g. a POST) raises rather than risk delivering it twice. The caller
+        must pass both values to release().
+        """
+        replayable = body is None or isinstance(body, (bytes, bytearray, list, tuple))
+        while True:
+            conn, reused = self._acquire()
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                return conn, conn.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused or not replayable or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                self.reconnects += 1
+            except BaseException:
+                conn.close()
+                raise
+
+    def release(self, conn, response):
+        """Return conn to the pool if it can carry another request, else close it."""
+        if conn.sock is None or not response.isclosed():
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn, _ in idle:
+            conn.close()
@@ -0,0 +1,135 @@
+# waf_workers.py
+# Pre-fork supervisor for running several WAF worker processes on one port.
+#
+# Each worker binds the WAF port itself with SO_REUSEPORT, so the kernel
+# spreads incoming connections across them and no process hands sockets to
+# another. Anything set up before run_workers() is called (signatures, the
+# ML model, GeoIP tables, shared rate-limit counters) is inherited by every
+# worker through fork, so it is loaded once rather than once per worker.
+
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+RESTART_DELAY = 1.0     # seconds to wait before restarting a worker that died right after starting
+MIN_UPTIME = 5.0        # a worker exiting sooner than this counts as crashing on startup
+STOP_TIMEOUT = 10.0     # seconds workers get to exit after SIGTERM before SIGKILL
+
+
+class _StopWorkers(Exception):
+    pass
+
+
+def workers_supported():
+    """True if this platform can fork and share a port with SO_REUSEPORT."""
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def _run_child(target, index):
+    """Body of a forked worker: run target(index) and exit without returning to the caller."""
+    code = 0
+    try:
+        # Ctrl-C reaches the whole process group; SIGTERM comes from the
+        # supervisor. Both should stop the worker the same way.
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        target(index)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code)
+
+
+def run_workers(count, target):
+    """
+    Fork count workers running target(index) and keep them running.
+
+    A worker that exits while the supervisor is not stopping is restarted
+    (after RESTART_DELAY if it did not stay up for MIN_UPTIME, so a worker
+    that cannot start does not spin). SIGINT or SIGTERM to the supervisor
+    stops all workers and returns.
+    """
+    stopping = []
+    waiting = []
+
+    def request_stop(signum, frame):
+        stopping.append(signum)
+        if waiting:
+            # os.wait() would otherwise be resumed after the handler returns.
+            raise _StopWorkers()
+
+    old_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+    children = {}  # pid -> (index, started_at)
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            _run_child(target, index)
+        children[pid] = (index, time.monotonic())
+        print(f"[*] Worker {index} started (pid {pid})")
+
+    try:
+        for index in range(count):
+            spawn(index)
+        while children and not stopping:
+            waiting.append(True)
+            try:
+                pid, status = os.wait()
+            except (ChildProcessError, _StopWorkers):
+                break
+            finally:
+                waiting.clear()
+            if pid not in children:
+                continue
+            index, started = children.pop(pid)
+            if stopping:
+                break
+            code = os.waitstatus_to_exitcode(status)
+            print(f"[WAF WORKERS] worker {index} (pid {pid}) exited with status {code}; restarting")
+            if time.monotonic() - started < MIN_UPTIME:
+                time.sleep(RESTART_DELAY)
+            if not stopping:
+                spawn(index)
+    finally:
+        _stop_children(children)
+        for sig, handler in old_handlers.items():
+            signal.signal(sig, handler)
+    print("[*] All workers stopped.")
+
+
+def _stop_children(children):
+    for pid in list(children):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            children.pop(pid, None)
+    deadline = time.monotonic() + STOP_TIMEOUT
+    while children:
+        for pid in list(children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                children.pop(pid, None)
+        if not children:
+            break
+        if time.monotonic() > deadline:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                except (ProcessLookupError, ChildProcessError):
+                    pass
+            break
+        time.sleep(0.05)